@@ -0,0 +1,91 @@
+"""
+BOSH body assembly benchmark: time to wrap 1, 10 and 100 stanzas into a
+BOSH <body>, comparing the old way (appending the stanza elements to a
+BOSHBody and serializing the whole tree) with PendingBody (serializing
+each stanza as it's queued, then concatenating). Both include the cost of
+serializing the stanzas, and both add an ack attribute to the body, since
+that's what send_body_to usually does. Serializing the stanzas is most of
+the cost either way, so the next column is PendingBody given the stanzas'
+text, as it is for messages that arrive over IPC with it. The last column
+is the cost of just wrapping stanzas that have already been queued, which
+is what PendingBody pays when a body is put together, and what the old
+way had to redo from scratch every time. The runs take turns, and garbage
+collection is off while timing, as with timeit.
+
+Usage: python benchmarks/bosh_body.py
+"""
+import gc, os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from xml.etree import ElementTree as ET
+from slixmpp.xmlstream import tostring
+from xmppserver.xmpp.bosh import BOSHBody, PendingBody
+from stanzas import message, presence
+
+def old_body(stanzas):
+    body = BOSHBody()
+    for xml in stanzas:
+        body.append(xml)
+    body.xml.attrib['ack'] = '12345'
+    return tostring(body.xml, top_level=True).encode('utf8')
+
+def new_body(stanzas):
+    body = PendingBody()
+    for xml in stanzas:
+        body.append(xml)
+    body['ack'] = '12345'
+    return body.serialize()
+
+def text_body(stanzas):
+    body = PendingBody()
+    for xml, text in stanzas:
+        body.append(xml, text)
+    body['ack'] = '12345'
+    return body.serialize()
+
+def wrap_body(body):
+    body['ack'] = '12345'
+    return body.serialize()
+
+def run(func, stanzas, rounds):
+    gc.disable()
+    start = time.perf_counter()
+    for i in range(rounds):
+        func(stanzas)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    return elapsed / rounds
+
+def main():
+    # stanzas arrive over the channel layer as elements
+    source = [ET.fromstring(presence(i) if i % 2 else message(i))
+              for i in range(100)]
+    print('%8s %12s %12s %12s %12s' % ('stanzas', 'old us/body',
+                                       'new us/body', 'text us/body',
+                                       'wrap us/body'))
+    for count in (1, 10, 100):
+        stanzas = source[:count]
+        assert ET.fromstring(old_body(stanzas)).attrib == \
+               ET.fromstring(new_body(stanzas)).attrib
+        texts = [(xml, tostring(xml, top_level=True)) for xml in stanzas]
+        assert text_body(texts) == new_body(stanzas)
+        body = PendingBody()
+        for xml in stanzas:
+            body.append(xml)
+        # take turns, so the machine's ups and downs hit all of them
+        rounds = 20000 // count
+        old = new = text = wrap = float('inf')
+        for i in range(5):
+            old = min(old, run(old_body, stanzas, rounds))
+            new = min(new, run(new_body, stanzas, rounds))
+            text = min(text, run(text_body, texts, rounds))
+            wrap = min(wrap, run(wrap_body, body, rounds))
+        print('%8d %12.1f %12.1f %12.1f %12.2f' % (count, old * 1e6,
+                                                   new * 1e6, text * 1e6,
+                                                   wrap * 1e6))
+
+if __name__ == '__main__':
+    main()
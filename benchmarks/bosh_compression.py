@@ -0,0 +1,55 @@
+"""
+BOSH response compression benchmark: response size and CPU time for
+typical BOSH responses, uncompressed and with gzip at various levels.
+The responses are a roster result, the presence burst that follows it
+(all contacts' presence in one body), a single chat message, and the
+empty body that answers most held requests.
+
+Usage: python benchmarks/bosh_compression.py
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from xmppserver.xmpp.bosh import compress_body, get_empty_body
+from stanzas import message, presence, roster_result
+
+def body(stanzas):
+    return ('<body xmlns="http://jabber.org/protocol/httpbind">%s</body>' %
+            ''.join(stanzas)).encode('utf8')
+
+def responses():
+    return [
+        ('roster x50', body([roster_result(50)])),
+        ('roster x500', body([roster_result(500)])),
+        ('presence x50', body([presence(i) for i in range(50)])),
+        ('presence x500', body([presence(i) for i in range(500)])),
+        ('message', body([message(1)])),
+        ('empty', get_empty_body()),
+    ]
+
+def run(data, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        result, headers = compress_body(data, [], b'gzip')
+    return len(result), (time.perf_counter() - start) / rounds
+
+def main():
+    print('%-14s %8s %6s %8s %7s %10s' % ('response', 'bytes', 'level',
+                                         'gzipped', 'ratio', 'us/body'))
+    for name, data in responses():
+        for level in (1, 6, 9):
+            settings.XMPP_BOSH_COMPRESSION_LEVEL = level
+            # measure everything, even what would be sent uncompressed
+            settings.XMPP_BOSH_COMPRESSION_MIN_SIZE = 0
+            rounds = max(10, 2000000 // len(data))
+            size, elapsed = min((run(data, rounds) for i in range(5)),
+                                key=lambda r: r[1])
+            print('%-14s %8d %6d %8d %6.1f%% %10.1f' % (
+                name, len(data), level, size, 100.0 * size / len(data),
+                elapsed * 1e6))
+
+if __name__ == '__main__':
+    main()
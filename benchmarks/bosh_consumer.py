@@ -0,0 +1,114 @@
+"""
+BOSH consumer setup benchmark: cost per request of creating a
+BOSHConsumer for a typical browser request, and asking whether its
+origin is trusted, comparing the old consumer (a LoggerAdapter, several
+header scans, and an uncached origin check per request) with the
+current one.
+
+Usage: python benchmarks/bosh_consumer.py
+"""
+import os, sys, time, logging, asyncio
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(ALLOWED_HOSTS=['chat.example.com'],
+                   SECURE_PROXY_SSL_HEADER=('HTTP_X_FORWARDED_PROTO', 'https'))
+
+from channels.consumer import AsyncConsumer
+from urllib.parse import urlparse
+from django.http.request import validate_host
+from xmppserver.consumers import BOSHConsumer, get_addr, get_client_host, \
+    get_host, get_origin
+from xmppserver.xmpp.bosh import get_content_encoding
+
+try:
+    AsyncConsumer({})
+except TypeError:
+    # Channels 3 and later no longer pass the scope to the constructor
+    AsyncConsumer.__init__ = lambda self, scope: setattr(self, 'scope', scope)
+
+def old_is_trusted_origin(origin):
+    allowed_hosts = settings.ALLOWED_HOSTS
+    try:
+        origin_host = urlparse(origin.decode()).hostname
+        return validate_host(origin_host, allowed_hosts)
+    except UnicodeDecodeError:
+        return False
+
+def get_accept_encoding(scope):
+    for hdr, value in scope['headers']:
+        if hdr == b'accept-encoding':
+            return value
+    return None
+
+class OldBOSHConsumer(AsyncConsumer):
+    def __init__(self, scope):
+        super(OldBOSHConsumer, self).__init__(scope)
+        self.logger = logging.LoggerAdapter(
+            logging.getLogger('xmppserver.transport.bosh'),
+            {'client': get_addr(scope)})
+        self.client_host = get_client_host(scope)
+        self.parser = None
+        self.rejected = False
+        self.stream = None
+        self.forward_task = None
+        self.forwarded = None
+        self.rid = None
+        self.answered = False
+        self.http_host = get_host(scope)
+        self.http_origin = get_origin(scope)
+        self.content_encoding = get_content_encoding(
+            get_accept_encoding(scope))
+        self.loop = asyncio.get_event_loop()
+
+    def is_trusted(self):
+        return old_is_trusted_origin(self.http_origin)
+
+def browser_scope():
+    return {
+        'type': 'http',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': '/chat/bind/',
+        'client': ('203.0.113.7', 51234),
+        'headers': [
+            (b'host', b'chat.example.com'),
+            (b'connection', b'keep-alive'),
+            (b'content-length', b'180'),
+            (b'user-agent', b'Mozilla/5.0 (X11; Linux x86_64) '
+                            b'AppleWebKit/537.36 (KHTML, like Gecko) '
+                            b'Chrome/120.0 Safari/537.36'),
+            (b'content-type', b'text/xml; charset=UTF-8'),
+            (b'accept', b'*/*'),
+            (b'origin', b'https://chat.example.com'),
+            (b'sec-fetch-site', b'same-origin'),
+            (b'sec-fetch-mode', b'cors'),
+            (b'sec-fetch-dest', b'empty'),
+            (b'referer', b'https://chat.example.com/chat/'),
+            (b'accept-encoding', b'gzip, deflate, br'),
+            (b'accept-language', b'en-US,en;q=0.9'),
+            (b'cookie', b'csrftoken=abcdef; sessionid=0123456789'),
+            (b'x-forwarded-proto', b'https'),
+        ],
+    }
+
+def run(cls, scope, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        consumer = cls(scope)
+        consumer.is_trusted()
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    scope = browser_scope()
+    rounds = 50000
+    old = min(run(OldBOSHConsumer, scope, rounds) for i in range(5))
+    new = min(run(BOSHConsumer, scope, rounds) for i in range(5))
+    print('%12s %12s' % ('consumer', 'us/request'))
+    print('%12s %12.2f' % ('old', old * 1e6))
+    print('%12s %12.2f' % ('new', new * 1e6))
+    print('%12s %11.2fx' % ('speedup', old / new))
+
+if __name__ == '__main__':
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    main()
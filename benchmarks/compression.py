@@ -0,0 +1,39 @@
+"""
+Stream compression (XEP-0138) benchmark: bytes on the wire and CPU time
+per stanza, for a typical session, at various zlib levels and windows.
+TCPStream compresses each batch of stanzas written in one event loop
+iteration and ends it with a sync flush; this benchmark assumes the worst
+case of one stanza per batch.
+
+Usage: python benchmarks/compression.py
+"""
+import time, zlib
+from stanzas import session
+
+def run(stanzas, level, wbits):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    total = 0
+    start = time.perf_counter()
+    for stanza in stanzas:
+        total += len(compressor.compress(stanza) +
+                     compressor.flush(zlib.Z_SYNC_FLUSH))
+    elapsed = time.perf_counter() - start
+    return total, elapsed
+
+def main():
+    stanzas = [s.encode('utf8') for s in session()]
+    raw = sum(len(s) for s in stanzas)
+    print('%d stanzas, %d bytes uncompressed' % (len(stanzas), raw))
+    print('%5s %6s %10s %7s %12s' % ('level', 'window', 'bytes', 'ratio',
+                                      'us/stanza'))
+    for level in (1, 6, 9):
+        for wbits in (9, 12, 15):
+            total, elapsed = min((run(stanzas, level, wbits)
+                                  for i in range(5)),
+                                 key=lambda r: r[1])
+            print('%5d %6d %10d %6.1f%% %12.2f' % (
+                level, wbits, total, 100.0 * total / raw,
+                elapsed * 1e6 / len(stanzas)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Stanza dispatch benchmark: the time it takes a logged-in stream to turn a
+received element into a stanza object and find its handlers, for each
+kind of stanza a client typically sends. The handlers themselves are not
+run, so only the dispatch is measured.
+
+Usage: python benchmarks/dispatch.py [count]
+"""
+import os, sys, time, asyncio, logging, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(XMPP_DOMAIN='example.com', CHANNEL_LAYERS={
+    'xmppserver': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+})
+
+from slixmpp import JID
+from slixmpp.xmlstream.handler import Callback
+from xmppserver.xmlparser import parse_xml
+from xmppserver.xmpp.tcp import TCPStream
+from stanzas import message, presence, ping
+
+def client_stanzas():
+    return {
+        'message': message(1),
+        'presence': presence(1),
+        'ping': ping(1),
+        'roster get': '<iq xmlns="jabber:client" type="get" id="r1">'
+                      '<query xmlns="jabber:iq:roster"/></iq>',
+        'disco info': '<iq xmlns="jabber:client" type="get" id="d1" '
+                      'to="example.com"><query xmlns='
+                      '"http://jabber.org/protocol/disco#info"/></iq>',
+        'remote iq': '<iq xmlns="jabber:client" type="get" id="v1" '
+                     'to="contact1@example.com/phone">'
+                     '<vCard xmlns="vcard-temp"/></iq>',
+        'sm ack': '<a xmlns="urn:xmpp:sm:3" h="10"/>',
+        'csi': '<active xmlns="urn:xmpp:csi:0"/>',
+    }
+
+class Factory(object):
+    options = None
+    direct_tls = False
+
+class Protocol(object):
+    logger = logging.getLogger('protocol')
+    factory = Factory()
+
+def make_stream():
+    stream = TCPStream(Protocol())
+    stream.boundjid = JID('user@example.com/laptop')
+    stream.features.add('mechanisms')
+    stream.prepare_features()
+    # unhandled stanzas get error replies, don't actually send them
+    stream.send = lambda data: None
+    return stream
+
+def run(stream, xml, count):
+    start = time.perf_counter()
+    for i in range(count):
+        stream.handle_stanza(xml)
+    return time.perf_counter() - start
+
+def main():
+    # stream setup complains about an unawaited coroutine, ignore that
+    warnings.simplefilter('ignore', RuntimeWarning)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    # only dispatch, don't run the handlers
+    Callback.run = lambda self, payload, instream=False: None
+    stream = make_stream()
+    print('%-12s %10s' % ('stanza', 'us/stanza'))
+    for name, text in client_stanzas().items():
+        xml = parse_xml(text)
+        elapsed = min(run(stream, xml, count) for i in range(3))
+        print('%-12s %10.2f' % (name, elapsed * 1e6 / count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+IPC delivery benchmark: chat messages from one user to another whose
+streams are handled by the same process, delivered directly (the
+default) or through the in-memory channel layer, as they used to be
+(XMPP_STREAM_LOCAL_DELIVERY = False). The receiving user has two
+WebSocket streams. The last row sends the messages along with their
+text, as the messaging code does, so that the receiving streams don't
+serialize them again. Reported are the throughput for a burst of
+messages, and the median and 99th percentile latency from ipc_send() to
+the receiving consumers' send_data() for messages sent one at a time.
+
+Usage: python benchmarks/ipc_delivery.py [count]
+"""
+import os, re, sys, time, asyncio, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(XMPP_DOMAIN='example.com',
+                   XMPP_STREAM_QUEUE_LIMIT=100000,
+                   CHANNEL_LAYERS={
+                       'xmppserver': {
+                           'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                           'CONFIG': {'capacity': 100000},
+                       },
+                   })
+
+from slixmpp import JID
+from xmppserver.xmlparser import parse_xml
+from xmppserver.xmpp.websockets import WSStream
+
+MESSAGE = ('<message xmlns="jabber:client" type="chat" '
+           'from="alice@example.com/laptop" to="bob@example.com" id="%d">'
+           '<body>Hi, are we still on for the meeting tomorrow?</body>'
+           '<active xmlns="http://jabber.org/protocol/chatstates"/>'
+           '</message>')
+
+class Consumer(object):
+    def __init__(self, stamps, latencies):
+        self.stamps = stamps
+        self.latencies = latencies
+
+    async def send_data(self, data):
+        now = time.perf_counter()
+        i = int(re.search(r'id="(\d+)"', data).group(1))
+        self.latencies.append(now - self.stamps[i])
+
+async def make_stream(jid, stamps, latencies):
+    stream = WSStream(Consumer(stamps, latencies))
+    stream.boundjid = JID(jid)
+    stream.features.add('mechanisms')
+    stream.prepare_features()
+    await stream.ipc_bind()
+    return stream
+
+async def run(count, burst, serialize):
+    stamps = [0] * count
+    latencies = []
+    alice = await make_stream('alice@example.com/laptop', stamps, latencies)
+    bobs = [await make_stream('bob@example.com/' + resource,
+                              stamps, latencies)
+            for resource in ('laptop', 'phone')]
+    target = JID('bob@example.com')
+    messages = [parse_xml(MESSAGE % i) for i in range(count)]
+    start = time.perf_counter()
+    for i, xml in enumerate(messages):
+        stamps[i] = time.perf_counter()
+        await alice.ipc_send('messaging.message', target, xml, serialize)
+        if not burst:
+            while len(latencies) < (i + 1) * len(bobs):
+                await asyncio.sleep(0)
+    while len(latencies) < count * len(bobs):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    for stream in [alice] + bobs:
+        stream.recv_task.cancel()
+        await stream._cleanup_task()
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            latencies[len(latencies) // 2],
+            latencies[len(latencies) * 99 // 100])
+
+async def compare(count):
+    print('%-14s %12s %10s %10s' % ('delivery', 'stanzas/s',
+                                    'p50 us', 'p99 us'))
+    for name, local, serialize in (('channel layer', False, False),
+                                   ('direct', True, False),
+                                   ('direct, text', True, True)):
+        settings.XMPP_STREAM_LOCAL_DELIVERY = local
+        rate = max([(await run(count, True, serialize))[0]
+                    for i in range(3)])
+        rate2, p50, p99 = await run(count, False, serialize)
+        print('%-14s %12.0f %10.1f %10.1f' % (name, rate,
+                                              p50 * 1e6, p99 * 1e6))
+
+def main():
+    # stream setup complains about an unawaited coroutine, ignore that
+    warnings.simplefilter('ignore', RuntimeWarning)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # the in-memory channel layer only works on one event loop
+    asyncio.run(compare(count))
+
+if __name__ == '__main__':
+    main()
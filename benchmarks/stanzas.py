@@ -0,0 +1,59 @@
+"""
+A corpus of typical client-to-server traffic, shared by the benchmarks.
+The stanzas are modelled on what a chat client sees after logging in:
+a roster result, a burst of presence from its contacts, and some chat.
+"""
+
+def roster_result(count=100):
+    items = ''.join(
+        '<item jid="contact%d@example.com" name="Contact Number %d" '
+        'subscription="both"><group>Friends</group></item>' % (i, i)
+        for i in range(count))
+    return ('<iq xmlns="jabber:client" type="result" id="roster_1" '
+            'to="user@example.com/laptop">'
+            '<query xmlns="jabber:iq:roster">%s</query></iq>' % items)
+
+def presence(i):
+    return ('<presence xmlns="jabber:client" '
+            'from="contact%d@example.com/phone" to="user@example.com">'
+            '<priority>5</priority><show>away</show>'
+            '<status>Out for lunch</status>'
+            '<c xmlns="http://jabber.org/protocol/caps" hash="sha-1" '
+            'node="https://conversations.im" '
+            'ver="Fc3LwRRk5PL0kYHMeeTRUxLnJ0U="/></presence>' % i)
+
+def message(i):
+    return ('<message xmlns="jabber:client" type="chat" id="msg%d" '
+            'from="contact%d@example.com/phone" to="user@example.com">'
+            '<body>Hi, are we still on for the meeting tomorrow? (%d)</body>'
+            '<active xmlns="http://jabber.org/protocol/chatstates"/>'
+            '<request xmlns="urn:xmpp:receipts"/></message>' % (i, i % 10, i))
+
+def chat_state(i):
+    return ('<message xmlns="jabber:client" type="chat" '
+            'from="contact%d@example.com/phone" to="user@example.com">'
+            '<composing xmlns="http://jabber.org/protocol/chatstates"/>'
+            '</message>' % (i % 10))
+
+def ping(i):
+    return ('<iq xmlns="jabber:client" type="get" id="ping%d" '
+            'to="example.com"><ping xmlns="urn:xmpp:ping"/></iq>' % i)
+
+def session(contacts=100, messages=50):
+    """The stanzas of a typical session, in order."""
+    stanzas = [roster_result(contacts)]
+    stanzas += [presence(i) for i in range(contacts)]
+    for i in range(messages):
+        stanzas.append(chat_state(i))
+        stanzas.append(message(i))
+    return stanzas
+
+def corpus():
+    """One of each kind of stanza, for per-stanza measurements."""
+    return {
+        'roster': roster_result(),
+        'presence': presence(1),
+        'message': message(1),
+        'chat state': chat_state(1),
+        'ping': ping(1),
+    }
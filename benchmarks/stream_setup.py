@@ -0,0 +1,74 @@
+"""
+Stream setup benchmark: how many streams per second a process can set
+up, and how much memory each of them takes, for WebSocket and plain XMPP
+connections. A stream is created when the client opens it, and gets its
+roster, presence and messaging components when it has authenticated, so
+both steps are measured. No network or database is involved.
+
+Usage: python benchmarks/stream_setup.py [count]
+"""
+import os, sys, time, asyncio, logging, tracemalloc, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(CHANNEL_LAYERS={
+    'xmppserver': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+})
+
+from xmppserver.xmpp.tcp import TCPStream
+from xmppserver.xmpp.websockets import WSStream
+
+class Consumer(object):
+    logger = logging.getLogger('consumer')
+
+class Factory(object):
+    options = object() # offer STARTTLS
+    direct_tls = False
+
+class Protocol(object):
+    logger = logging.getLogger('protocol')
+    factory = Factory()
+
+def make_ws():
+    return WSStream(Consumer())
+
+def make_tcp():
+    return TCPStream(Protocol())
+
+def login(stream):
+    stream.features.add('mechanisms')
+    stream.prepare_features()
+    return stream
+
+def run(make, count):
+    start = time.perf_counter()
+    for i in range(count):
+        make()
+    return count / (time.perf_counter() - start)
+
+def memory(make, count):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    streams = [make() for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return total / len(streams)
+
+def main():
+    # stream setup complains about an unawaited coroutine, ignore that
+    warnings.simplefilter('ignore', RuntimeWarning)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print('%-10s %-8s %12s %14s' % ('transport', 'step', 'streams/s',
+                                     'bytes/stream'))
+    for name, make in (('websocket', make_ws), ('tcp', make_tcp)):
+        make()
+        for step, func in (('open', make),
+                           ('login', lambda: login(make()))):
+            rate = max(run(func, count) for i in range(3))
+            size = memory(func, min(count, 200))
+            print('%-10s %-8s %12.0f %14.0f' % (name, step, rate, size))
+
+if __name__ == '__main__':
+    main()
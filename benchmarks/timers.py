@@ -0,0 +1,58 @@
+"""
+BOSH timer benchmark: scheduler overhead at high session counts, for
+loop.call_later versus the timer wheel. Every session has a wait timer
+armed, and each simulated request cancels one and arms a new one, as
+BOSHStream does. Reported are the cost of one such rearm, and of one
+event loop iteration with all the timers pending (which for call_later
+includes the heap upkeep for the cancelled handles).
+
+Usage: python benchmarks/timers.py
+"""
+import os, sys, time, asyncio, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from xmppserver.timers import TimerWheel
+
+WAIT = 60
+
+def callback():
+    pass
+
+def run(loop, call_later, sessions, requests):
+    handles = [call_later(WAIT + random.random(), callback)
+               for i in range(sessions)]
+    order = [random.randrange(sessions) for i in range(requests)]
+    start = time.perf_counter()
+    for i in order:
+        handles[i].cancel()
+        handles[i] = call_later(WAIT + random.random(), callback)
+    rearm = (time.perf_counter() - start) / requests
+    # let the loop go around a number of times
+    iterations = 1000
+    async def spin():
+        for i in range(iterations):
+            await asyncio.sleep(0)
+    start = time.perf_counter()
+    loop.run_until_complete(spin())
+    iteration = (time.perf_counter() - start) / iterations
+    for handle in handles:
+        handle.cancel()
+    return rearm, iteration
+
+def main():
+    print('%8s %10s %12s %12s' % ('sessions', 'timers', 'us/rearm',
+                                  'us/iteration'))
+    for sessions in (1000, 10000, 50000, 100000):
+        for name in ('call_later', 'wheel'):
+            loop = asyncio.new_event_loop()
+            if name == 'wheel':
+                call_later = TimerWheel(loop).call_later
+            else:
+                call_later = loop.call_later
+            rearm, iteration = run(loop, call_later, sessions, sessions * 2)
+            loop.close()
+            print('%8d %10s %12.2f %12.2f' % (sessions, name,
+                                              rearm * 1e6, iteration * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+WebSocket outbound benchmark: bursts of stanzas sent to a WSStream,
+comparing the old way (a task per stanza) with the single writer
+coroutine. Reported are the tasks created per burst, throughput, and
+the median and 99th percentile latency from send_raw() to the consumer's
+send_data(). The consumer hands messages to an unbounded queue, which is
+roughly what an ASGI server does.
+
+Usage: python benchmarks/ws_writer.py
+"""
+import os, sys, time, asyncio, warnings
+from collections import deque
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(XMPP_STREAM_QUEUE_LIMIT=100000)
+
+from xmppserver.xmpp.websockets import WSStream
+from stanzas import message, presence
+
+class Consumer(object):
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.latencies = []
+
+    async def send_data(self, data):
+        now = time.perf_counter()
+        self.latencies.append(now - self.stamps.popleft())
+        await self.queue.put(data)
+
+class OldWSStream(WSStream):
+    # send_raw as it used to be
+    def __init__(self, consumer):
+        super(OldWSStream, self).__init__(consumer)
+        self.pending_sends = 0
+
+    def send_raw(self, data, key=None):
+        if self.consumer is None:
+            return
+        self.pending_sends += 1
+        task = self.loop.create_task(self.consumer.send_data(data))
+        task.add_done_callback(self._send_done)
+
+    def _send_done(self, task):
+        self.pending_sends -= 1
+
+async def run(cls, stanzas, bursts):
+    loop = asyncio.get_event_loop()
+    tasks = [0]
+    def factory(loop, coro, **kwargs):
+        tasks[0] += 1
+        return asyncio.Task(coro, loop=loop, **kwargs)
+    loop.set_task_factory(factory)
+    consumer = Consumer()
+    consumer.stamps = deque()
+    stream = cls(consumer)
+    start = time.perf_counter()
+    for i in range(bursts):
+        for data in stanzas:
+            consumer.stamps.append(time.perf_counter())
+            stream.send_raw(data)
+        while consumer.queue.qsize() < len(stanzas):
+            await asyncio.sleep(0)
+        while not consumer.queue.empty():
+            consumer.queue.get_nowait()
+    elapsed = time.perf_counter() - start
+    loop.set_task_factory(None)
+    latencies = sorted(consumer.latencies)
+    return (tasks[0] / bursts,
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2],
+            latencies[len(latencies) * 99 // 100])
+
+def main():
+    # stream setup complains about an unawaited coroutine, ignore that
+    warnings.simplefilter('ignore', RuntimeWarning)
+    source = [presence(i) if i % 2 else message(i) for i in range(1000)]
+    print('%6s %8s %12s %14s %10s %10s' % ('burst', 'writer', 'tasks/burst',
+                                           'stanzas/s', 'p50 us', 'p99 us'))
+    for size in (1, 10, 100, 1000):
+        stanzas = source[:size]
+        bursts = max(20000 // size, 20)
+        for name, cls in (('task', OldWSStream), ('single', WSStream)):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            tasks, rate, p50, p99 = loop.run_until_complete(
+                run(cls, stanzas, bursts))
+            loop.close()
+            print('%6d %8s %12.1f %14.0f %10.1f %10.1f' % (
+                size, name, tasks, rate, p50 * 1e6, p99 * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+XML parser benchmark: parse throughput for each available XMPP_XML_PARSER
+backend over a typical session (see stanzas.py), both one document per
+stanza, as WebSocket messages are parsed, and as a single stream fed to a
+pull parser, as plain XMPP connections are parsed. The defaults, used
+when XMPP_XML_PARSER isn't set, are included too: defusedxml for
+documents, and an unprotected XMLPullParser for streams.
+
+Usage: python benchmarks/xml_parsers.py
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from xmppserver.xmlparser import backends, get_xml_backend, \
+    make_pull_parser, parse_xml
+from stanzas import session
+
+STREAM_HEADER = (b"<stream:stream xmlns='jabber:client' "
+                 b"xmlns:stream='http://etherx.jabber.org/streams' "
+                 b"to='example.com' version='1.0'>")
+
+def run_documents(parse, stanzas):
+    start = time.perf_counter()
+    for data in stanzas:
+        parse(data)
+    return time.perf_counter() - start
+
+def run_stream(make_parser, stanzas):
+    start = time.perf_counter()
+    parser = make_parser()
+    parser.feed(STREAM_HEADER)
+    for data in stanzas:
+        parser.feed(data)
+        for event, elem in parser.read_events():
+            pass
+    return time.perf_counter() - start
+
+def report(name, mode, elapsed, stanzas, size):
+    print('%-12s %-9s %12.2f %10.1f' % (name, mode,
+                                         elapsed * 1e6 / len(stanzas),
+                                         size / elapsed / 1e6))
+
+def main():
+    stanzas = [stanza.encode('utf8') for stanza in session()]
+    size = sum(len(data) for data in stanzas)
+    print('%d stanzas, %d bytes' % (len(stanzas), size))
+    print('%-12s %-9s %12s %10s' % ('parser', 'mode', 'us/stanza', 'MB/s'))
+    elapsed = min(run_documents(parse_xml, stanzas) for i in range(5))
+    report('default', 'document', elapsed, stanzas, size)
+    elapsed = min(run_stream(make_pull_parser, stanzas) for i in range(5))
+    report('default', 'stream', elapsed, stanzas, size)
+    for name in sorted(backends):
+        if not backends[name].available():
+            print('%-12s (not installed)' % name)
+            continue
+        settings.XMPP_XML_PARSER = name
+        backend = get_xml_backend()
+        elapsed = min(run_documents(backend.parse, stanzas) for i in range(5))
+        report(name, 'document', elapsed, stanzas, size)
+        elapsed = min(run_stream(backend.make_pull_parser, stanzas)
+                      for i in range(5))
+        report(name, 'stream', elapsed, stanzas, size)
+
+if __name__ == '__main__':
+    main()
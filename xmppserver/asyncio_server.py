@@ -0,0 +1,170 @@
+from .xmpp.tcp import TCPStream
+from .conf import settings
+from .shaping import admit_connection
+from .utils import format_addr
+from .xmpp_server import create_listen_socket
+import asyncio, logging, ssl
+
+class XMPPServer(asyncio.Protocol):
+    def __init__(self, factory):
+        self.stream = None
+        self.factory = factory
+        self.logger = factory.logger
+        self.client = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        try:
+            peer = transport.get_extra_info('peername')
+            self.client = format_addr(peer[0], peer[1])
+            self.logger = logging.LoggerAdapter(self.factory.logger,
+                                                {'client': self.client})
+            if not admit_connection(peer[0]):
+                self.logger.warning('Connection rate exceeded, refusing connection')
+                transport.abort()
+                return
+            self.logger.info('Connected')
+            self.stream = TCPStream(self)
+        except:
+            self.logger.exception('Error opening stream')
+            transport.abort()
+
+    def data_received(self, data):
+        if self.stream:
+            try:
+                self.logger.debug('Receive: %s', data)
+                self.stream.data_received(data)
+            except:
+                self.logger.exception('Error processing data')
+                self.transport.abort()
+
+    def connection_lost(self, exc=None):
+        if self.stream:
+            try:
+                self.logger.info('Disconnected')
+                self.stream.connection_lost()
+            except:
+                self.logger.exception('Error closing stream')
+            self.stream = None
+
+    def pause_writing(self):
+        if self.stream:
+            self.stream.pause_writing()
+
+    def resume_writing(self):
+        if self.stream:
+            self.stream.resume_writing()
+
+    # interface used by TCPStream
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+    def abort(self):
+        self.transport.abort()
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def start_tls(self, options):
+        # The client won't send anything but the TLS handshake from
+        # now on, so stop reading plaintext until the upgrade is done.
+        self.transport.pause_reading()
+        asyncio.ensure_future(self._start_tls(options))
+
+    async def _start_tls(self, options):
+        loop = asyncio.get_event_loop()
+        try:
+            self.transport = await loop.start_tls(self.transport, self,
+                                                  options,
+                                                  server_side=True)
+        except Exception:
+            self.logger.info('TLS handshake failed')
+            self.transport.abort()
+
+    def get_peer_certificate(self):
+        return self.transport.get_extra_info('peercert')
+
+def load_tls_options(logger):
+    # The context is shared by all connections and listeners,
+    # so the TLS session cache is too.
+    if settings.TLS_CERT_PATH and settings.TLS_PRIV_KEY_PATH:
+        try:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(settings.TLS_CERT_PATH,
+                                    settings.TLS_PRIV_KEY_PATH)
+            if settings.TLS_CACERT_PATHS:
+                for path in settings.TLS_CACERT_PATHS:
+                    context.load_verify_locations(path)
+                context.verify_mode = ssl.CERT_OPTIONAL
+        except (IOError, ssl.SSLError):
+            logger.exception("Couldn't load XMPP server certificate, TLS disabled")
+            return None
+        if not settings.TLS_SESSION_RESUMPTION:
+            # OpenSSL issues session tickets by default
+            context.options |= ssl.OP_NO_TICKET
+            if hasattr(context, 'num_tickets'):
+                context.num_tickets = 0
+        return context
+    else:
+        logger.warning('XMPP server certificate not configured, TLS disabled')
+        return None
+
+class XMPPServerFactory(object):
+    def __init__(self, logger, options, direct_tls=False):
+        self.logger = logger
+        self.options = options
+        self.direct_tls = direct_tls
+
+    def __call__(self):
+        return XMPPServer(self)
+
+def get_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        # The event loop usually isn't running yet when routing.py
+        # is imported, but the ASGI server has already set it up.
+        return asyncio.get_event_loop_policy().get_event_loop()
+
+def listen(logger, factory, port, ssl=None):
+    # The port is bound right away, so that errors (e.g. the port
+    # being in use) stop the startup, and the listener starts
+    # accepting connections once the event loop runs.
+    sock = create_listen_socket(port, settings.TCP_REUSE_PORT, 100)
+    loop = get_loop()
+    task = loop.create_task(loop.create_server(factory, sock=sock, ssl=ssl))
+
+    def listening(task):
+        if task.cancelled():
+            sock.close()
+            return
+        exc = task.exception()
+        if exc is not None:
+            # nothing is going to be listening on this port,
+            # so don't pretend that everything is fine
+            logger.critical("Couldn't listen on port %d, stopping",
+                            port, exc_info=exc)
+            sock.close()
+            loop.stop()
+    task.add_done_callback(listening)
+
+def start_server(logger):
+    options = load_tls_options(logger)
+    if options is None and settings.TCP_REQUIRE_TLS:
+        raise Exception("XMPP_TCP_REQUIRE_TLS is True, but XMPP server certificate not available")
+    if settings.TCP_DIRECT_TLS_PORT and options is None:
+        raise Exception("XMPP_TCP_DIRECT_TLS_PORT is set, but XMPP server certificate not available")
+    listen(logger, XMPPServerFactory(logger, options),
+           settings.TCP_CLIENT_PORT)
+    if settings.TCP_DIRECT_TLS_PORT:
+        factory = XMPPServerFactory(logger, options, direct_tls=True)
+        listen(logger, factory, settings.TCP_DIRECT_TLS_PORT, ssl=options)
@@ -0,0 +1,122 @@
+from channels.layers import get_channel_layer
+import asyncio, itertools, logging, uuid
+
+logger = logging.getLogger('xmppserver.cluster')
+
+# Every server process has a channel of its own on the channel layer,
+# so that other processes can forward requests to it, e.g. BOSH
+# requests for sessions that this process owns.
+node_id = uuid.uuid4().hex[:16]
+node_channel = 'xmpp.node.' + node_id
+
+def make_owned_id(id):
+    # tag an id (e.g. a BOSH sid) with the process that owns it
+    return '%s.%s' % (id, node_id)
+
+def get_owner_channel(id):
+    # Returns the channel of the process that owns the id,
+    # or None if it's not tagged or we own it ourselves.
+    if '.' not in id:
+        return None
+    owner = id.rsplit('.', 1)[1]
+    if owner == node_id or not owner.isalnum():
+        return None
+    return 'xmpp.node.' + owner
+
+class Node(object):
+    def __init__(self):
+        self.channel_layer = None
+        self.recv_task = None
+        self.handlers = {}
+        self.pending = {}
+        self.pending_acks = {}
+        self.request_ids = itertools.count()
+
+    def register_handler(self, type, handler):
+        self.handlers[type] = handler
+
+    def start(self):
+        if self.recv_task is None:
+            logger.info('Listening on node channel %s', node_channel)
+            self.channel_layer = get_channel_layer('xmppserver')
+            self.recv_task = asyncio.ensure_future(self._receive_task())
+
+    def new_request_id(self):
+        return next(self.request_ids)
+
+    async def send(self, channel, msg):
+        self.start()
+        await self.channel_layer.send(channel, msg)
+
+    async def request(self, channel, msg, timeout, ack_timeout=None):
+        # Sends msg to another node and waits for its reply.
+        # The caller may set msg['request_id'] in advance.
+        # With ack_timeout, the other node must also acknowledge
+        # the request that soon, so that a node that's gone is
+        # noticed without waiting for the whole timeout.
+        # Raises asyncio.TimeoutError if either doesn't arrive.
+        self.start()
+        if 'request_id' not in msg:
+            msg['request_id'] = self.new_request_id()
+        request_id = msg['request_id']
+        msg['reply_to'] = node_channel
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.pending[request_id] = fut
+        ack = None
+        if ack_timeout is not None:
+            msg['ack'] = True
+            ack = loop.create_future()
+            self.pending_acks[request_id] = ack
+        try:
+            await self.channel_layer.send(channel, msg)
+            if ack is not None:
+                done, _ = await asyncio.wait(
+                    [ack, fut], timeout=ack_timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+            self.pending_acks.pop(request_id, None)
+
+    async def reply(self, request, msg):
+        msg['type'] = 'node.reply'
+        msg['request_id'] = request['request_id']
+        await self.channel_layer.send(request['reply_to'], msg)
+
+    async def _receive_task(self):
+        while True:
+            msg = await self.channel_layer.receive(node_channel)
+            type = msg.get('type')
+            if type == 'node.reply':
+                fut = self.pending.get(msg['request_id'])
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+                continue
+            if type == 'node.ack':
+                fut = self.pending_acks.get(msg['request_id'])
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
+                continue
+            handler = self.handlers.get(type)
+            if handler is None:
+                logger.warning('Unknown message type %s on node channel', type)
+                continue
+            # handlers may take a while (e.g. held BOSH requests),
+            # so don't let them hold up the other messages
+            asyncio.ensure_future(self._handle(handler, msg))
+
+    async def _handle(self, handler, msg):
+        try:
+            if msg.get('ack'):
+                await self.channel_layer.send(msg['reply_to'], {
+                    'type': 'node.ack',
+                    'request_id': msg['request_id'],
+                })
+            await handler(msg)
+        except Exception:
+            logger.exception('Error handling %s message', msg.get('type'))
+
+node = Node()
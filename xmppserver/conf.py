@@ -117,12 +117,139 @@ class Settings(object):
     Time before an inactive BOSH client is presumed dead, in seconds.
     """
 
+    BOSH_POLLING = 5
+    """
+    Shortest allowed interval between empty requests from polling BOSH
+    clients (those that ask for a hold of 0), in seconds. Polling clients
+    that send two empty requests closer together than this are disconnected.
+    """
+
+    BOSH_ADAPTIVE = False
+    """
+    Whether to shorten the BOSH wait time, and lower the number of held
+    requests, when this server process is busy. Idle clients then hold
+    fewer connections open, and come back sooner to check for new data.
+    The load is checked for every request, but a session is never given
+    more than it was told when it was created, since clients won't open
+    more connections than that; so sessions created while the process
+    was busy stay limited after the load goes down, until they end.
+    """
+
+    BOSH_ADAPTIVE_MAX_HELD = 10000
+    """
+    Number of held BOSH requests at which a server process is considered
+    fully loaded, if adaptive mode is enabled. At full load, the wait time is
+    reduced to ``XMPP_BOSH_MIN_WAIT`` and each client is allowed to hold
+    only one request.
+    """
+
+    BOSH_ADAPTIVE_MAX_LAG = 0.1
+    """
+    Event loop lag, in seconds, at which a server process is considered
+    fully loaded, if adaptive mode is enabled.
+    """
+
+    BOSH_MAX_BODY_SIZE = 1048576
+    """
+    Maximum size of a BOSH request body, in bytes. Larger requests are
+    rejected as soon as they exceed it, with HTTP status 413.
+    """
+
+    BOSH_MAX_BODY_DEPTH = 64
+    """
+    Maximum nesting depth of the XML elements in a BOSH request body.
+    Deeper requests are rejected, with HTTP status 413.
+    """
+
+    BOSH_REPLY_CACHE_SIZE = 65536
+    """
+    Maximum number of bytes of BOSH replies kept per session in case the
+    client needs them retransmitted. When exceeded, the oldest replies are
+    evicted, and a client asking for one of those gets a recoverable error.
+    (The most recent reply is always kept.)
+    """
+
+    BOSH_REPLY_CACHE_TOTAL = 16777216
+    """
+    Maximum number of bytes of BOSH replies kept for retransmission by
+    each server process, for all sessions together. When exceeded, the
+    oldest replies are evicted, regardless of which session they belong to.
+    """
+
+    BOSH_COMPRESSION = False
+    """
+    Whether to compress BOSH responses with gzip or deflate, for clients
+    that accept it (which browsers do). The first responses of a session,
+    with the roster and everyone's presence, often compress to a fraction
+    of their size, at the cost of some CPU time. Don't enable this if a
+    reverse proxy in front of the server already compresses responses.
+    """
+
+    BOSH_COMPRESSION_LEVEL = 6
+    """
+    The zlib compression level for BOSH responses,
+    from 1 (fastest) to 9 (smallest).
+    """
+
+    BOSH_COMPRESSION_MIN_SIZE = 1024
+    """
+    BOSH responses smaller than this many bytes are sent uncompressed,
+    since compressing them would hardly save anything.
+    """
+
+    BOSH_CLUSTER_ROUTING = False
+    """
+    Whether BOSH requests may arrive at any server process, rather than
+    only the one that owns the session. If so, the session IDs tell which
+    process owns the session, and requests that arrive at the wrong process
+    are forwarded to the right one over the channel layer. This lets you run
+    several server processes behind a plain round-robin load balancer,
+    without sticky sessions, but requires a channel layer that is shared
+    between the processes, such as ``channels_redis``.
+    """
+
+    BOSH_CLUSTER_ACK_TIMEOUT = 5
+    """
+    With cluster routing, how many seconds a server process waits for the
+    process that owns a BOSH session to acknowledge a forwarded request.
+    If it doesn't (e.g. because it has been shut down), the session is
+    terminated right away, rather than after the full BOSH wait time.
+    """
+
     WEBSOCKETS_URL = None
     """
     The URL to the WebSockets consumer. Used by the template tags.
     If unset, the URL will be deduced from your project's URLconf.
     """
 
+    WEBSOCKETS_MAX_MESSAGE_SIZE = 1048576
+    """
+    Maximum size of a WebSocket message from a client, in bytes (after
+    decompression, if any). Clients that send larger messages are
+    disconnected.
+    """
+
+    WEBSOCKETS_DEFLATE = False
+    """
+    Whether to offer compressed WebSocket messages, under the ``xmpp-deflate``
+    subprotocol. This is not a standard, so clients have to know about it;
+    see :ref:`websocket-compression`. (WebSocket compression negotiated by
+    the ASGI server itself, i.e. permessage-deflate, doesn't need this.)
+    """
+
+    WEBSOCKETS_DEFLATE_LEVEL = 6
+    """
+    The zlib compression level for compressed WebSocket messages,
+    from 1 (fastest) to 9 (smallest).
+    """
+
+    WEBSOCKETS_DEFLATE_WINDOW = 15
+    """
+    The base-two logarithm of the zlib window size for compressed
+    WebSocket messages, from 9 to 15. Smaller windows use less memory per
+    connection, but compress less effectively.
+    """
+
     TCP_SERVER = True
     """
     Whether to allow starting the plain XMPP server. To actually start it,
@@ -132,11 +259,41 @@ class Settings(object):
         xmpp_server.start_xmpp_server()
     """
 
+    TCP_BACKEND = 'twisted'
+    """
+    The networking library used by the plain XMPP server. The default,
+    ``'twisted'``, requires Twisted and pyOpenSSL. Set it to ``'asyncio'``
+    to serve plain XMPP directly on the asyncio event loop instead, which
+    avoids passing every stanza through Twisted and does not require Twisted
+    to be installed. The asyncio backend requires Python 3.7 or later.
+    """
+
     TCP_CLIENT_PORT = 5222
     """
     The XMPP client-to-server port to listen on.
     """
 
+    TCP_REUSE_PORT = False
+    """
+    Whether to bind the client port with ``SO_REUSEPORT``. This allows
+    several server processes (for example, several Daphne instances
+    that all call ``start_xmpp_server``) to listen on the same port,
+    with the operating system spreading incoming connections across
+    them, so that plain XMPP clients are not limited to a single process.
+    All the processes must use a shared channel layer (not the in-memory
+    channel layer). Requires an operating system that supports
+    ``SO_REUSEPORT``, such as Linux 3.9 or later.
+    """
+
+    TCP_DIRECT_TLS_PORT = None
+    """
+    An additional port to listen on for direct TLS connections (XEP-0368),
+    e.g. 5223. On this port, the TLS handshake is done before the XMPP stream
+    is opened, which saves clients the round trips of STARTTLS. Clients find
+    the port through an ``_xmpps-client._tcp`` DNS SRV record.
+    Requires the XMPP server certificate.
+    """
+
     TCP_SERVER_PORT = 5269
     """
     The XMPP server-to-server port to listen on.
@@ -148,6 +305,37 @@ class Settings(object):
     Whether to require TLS-secured connections.
     """
 
+    TCP_MAX_STANZA_SIZE = 1048576
+    """
+    Maximum size of a stanza from a plain XMPP client, in bytes (after
+    decompression, if stream compression is used). Clients that send
+    larger stanzas are disconnected with a ``policy-violation`` stream
+    error.
+    """
+
+    TCP_COMPRESSION = False
+    """
+    Whether to offer stream compression (XEP-0138) to plain XMPP clients.
+    XMPP traffic usually compresses well, so this can save a lot of
+    bandwidth for clients on slow or metered networks, at the cost of
+    some CPU time and memory per connection. Compression is only offered
+    after the client has authenticated (and started TLS, if available).
+    """
+
+    TCP_COMPRESSION_LEVEL = 6
+    """
+    The zlib compression level for stream compression,
+    from 1 (fastest) to 9 (smallest).
+    """
+
+    TCP_COMPRESSION_WINDOW = 15
+    """
+    The base-two logarithm of the zlib window size for stream compression,
+    from 9 to 15. Smaller windows use less memory per connection (the
+    compressor needs roughly four times the window size, plus 128 KB),
+    but compress less effectively.
+    """
+
     TLS_CERT_PATH = None
     """
     Path to the X.509 certificate, in PEM format. Required for TLS.
@@ -158,6 +346,22 @@ class Settings(object):
     Path to the X.509 private key, in PEM format. Required for TLS.
     """
 
+    TLS_SESSION_RESUMPTION = True
+    """
+    Whether to allow TLS clients to resume previous TLS sessions (through
+    session IDs or session tickets), which makes reconnecting much cheaper
+    for both the clients and the server, since a full handshake isn't needed.
+
+    The session cache and the session ticket keys only live in the memory
+    of each server process, and neither Python's ``ssl`` module nor
+    pyOpenSSL lets us load ticket keys from elsewhere. So sessions can only
+    be resumed with the same process that started them: not after the
+    server is restarted (e.g. by a deploy), and not across processes that
+    share the client port through ``XMPP_TCP_REUSE_PORT``, since a client
+    that reconnects may well end up at another process. Clients that can't
+    resume just do a full handshake.
+    """
+
     TLS_CACERT_PATHS = []
     """
     Paths to CA certificates to be used for validating client certificates,
@@ -165,6 +369,135 @@ class Settings(object):
     This feature is not yet implemented.
     """
 
+    XML_PARSER = None
+    """
+    The XML parser used for incoming XMPP streams, BOSH requests, and
+    WebSocket messages: ``'expat'`` (the standard library's parser),
+    ``'defusedxml'`` (requires defusedxml), or ``'lxml'`` (requires lxml).
+    Whichever you choose, documents that contain a DTD are rejected, so
+    entities can't be declared and expanded.
+    If unset, BOSH requests and WebSocket messages are parsed with
+    defusedxml (or ``'expat'`` if defusedxml isn't installed), and plain
+    XMPP streams with the standard library's parser, without the DTD check.
+    ``'expat'`` is the fastest choice for BOSH and WebSockets. ``'lxml'``
+    is the slowest, since the elements are built through Python callbacks;
+    it's there for deployments that want libxml2 to do the parsing.
+    See ``benchmarks/xml_parsers.py`` for how they compare.
+    """
+
+    STREAM_QUEUE_LIMIT = 1000
+    """
+    Maximum number of outbound stanzas that may be waiting for a client
+    that isn't reading them fast enough (e.g. a mobile client on a bad
+    network, or a BOSH client that hasn't polled). When the limit is
+    exceeded, the action given by ``XMPP_STREAM_QUEUE_POLICY`` is taken.
+    The current queue sizes can be monitored with
+    ``xmppserver.xmpp.stream.get_queue_stats()``.
+    """
+
+    STREAM_QUEUE_POLICY = 'pause'
+    """
+    What to do when a client's outbound queue exceeds
+    ``XMPP_STREAM_QUEUE_LIMIT``. With ``'pause'``, the stream stops
+    receiving messages from other streams (they are left waiting in its
+    inbox and the channel layer) until the queue has drained to half the
+    limit. With ``'drop-presence'``, queued presence stanzas that have been
+    superseded by newer presence from the same sender are discarded, and
+    if that's not enough, the stream is paused. With ``'close'``, the stream is
+    closed with a ``policy-violation`` stream error.
+    """
+
+    STREAM_RESUME_TIMEOUT = 300
+    """
+    How many seconds to keep the session of a plain XMPP or WebSocket
+    client whose connection was lost, if the client has enabled session
+    resumption through Stream Management (XEP-0198). If the client
+    reconnects in time, it can resume the session without logging in again,
+    and receives any stanzas it missed. Note that the client has to
+    reconnect to the same server process. Set to 0 to disable resumption.
+    """
+
+    STREAM_PING_INTERVAL = None
+    """
+    If set, the server pings (XEP-0199) plain XMPP and WebSocket clients
+    that haven't sent anything for this many seconds (or up to twice as
+    many), to find connections that died without being closed. Without
+    it, such sessions can linger, and keep receiving presence, until
+    the operating system gives up on the connection. BOSH sessions don't
+    need it, they have ``XMPP_BOSH_MAX_INACTIVITY``.
+    """
+
+    STREAM_PING_TIMEOUT = 60
+    """
+    How many seconds a pinged client has to respond (with anything)
+    before its connection is dropped. The session then ends, or waits
+    for resumption if the client has enabled it (see
+    ``XMPP_STREAM_RESUME_TIMEOUT``).
+    """
+
+    STREAM_LOCAL_DELIVERY = True
+    """
+    Deliver stanzas between sessions handled by the same server process
+    directly, instead of passing them through the channel layer. With the
+    in-memory channel layer, the channel layer isn't used for stanzas at
+    all. With a shared channel layer, stanzas are still sent through it for
+    the sessions in other processes (the sessions in the sending process
+    ignore those copies).
+    """
+
+    FORWARDED_FOR_HEADER = None
+    """
+    The HTTP header in which your reverse proxy passes on the client's IP
+    address, e.g. ``'X-Forwarded-For'``. If set, BOSH and WebSocket clients
+    are identified by the last address in this header (the one added by
+    your proxy), for logging and for the connection limits below. Otherwise,
+    they are identified by the address the ASGI server reports, which is
+    the proxy's own address, unless the ASGI server already handles the
+    header itself (e.g. Daphne with ``--proxy-headers``). Only set this if
+    all requests come through the proxy, since clients can send any header
+    they like.
+    """
+
+    LIMIT_CONNECTION_RATE = None
+    """
+    Maximum average number of new connections per second accepted from
+    a single IP address, counting plain XMPP and WebSocket connections and
+    new BOSH sessions. Connections beyond the limit are refused.
+    ``None`` means no limit.
+    """
+
+    LIMIT_CONNECTION_BURST = 10
+    """
+    Number of new connections a single IP address may open in quick
+    succession before ``XMPP_LIMIT_CONNECTION_RATE`` kicks in.
+    """
+
+    LIMIT_STANZA_RATE = None
+    """
+    Maximum average number of stanzas per second that a client may send.
+    If a client sends more, the server reads from it more slowly, instead
+    of dropping the stream. ``None`` means no limit.
+    """
+
+    LIMIT_STANZA_BURST = 100
+    """
+    Number of stanzas a client may send in quick succession
+    before ``XMPP_LIMIT_STANZA_RATE`` kicks in.
+    """
+
+    LIMIT_BYTE_RATE = None
+    """
+    Maximum average number of bytes per second that a client may send.
+    If a client sends more, the server reads from it more slowly, instead
+    of dropping the stream. ``None`` means no limit.
+    """
+
+    LIMIT_BYTE_BURST = 65536
+    """
+    Number of bytes a client may send in quick succession
+    before ``XMPP_LIMIT_BYTE_RATE`` kicks in.
+    """
+
     SERVER = None
     """
     If you need the template tags to return a full URL, you can set this to
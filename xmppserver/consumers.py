@@ -1,24 +1,25 @@
 from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
 from channels.exceptions import StopConsumer
 from channels.consumer import AsyncConsumer
 from django.conf import settings as django_settings
+from django.core.exceptions import PermissionDenied
 from django.http.request import validate_host
 from django.utils.functional import cached_property
+from functools import lru_cache
 from urllib.parse import urlparse
-from .xmpp.bosh import handle_bosh, disconnect_bosh
+from .templatetags.xmpp import get_chat_domain
+from .xmpp.bosh import handle_bosh, disconnect_bosh, \
+    compress_body, get_content_encoding, prebind_bosh_stream
 from .xmpp.websockets import handle_ws, disconnect_ws
 from .conf import settings
+from .framing import select_framing
+from .hooks import get_hook
+from .shaping import admit_connection
 from .utils import format_addr
-import asyncio, logging
-
-try:
-    from defusedxml import ElementTree as ET
-    def parse_xml(text):
-        return ET.fromstring(text, forbid_dtd=True)
-except ImportError:
-    from xml.etree import ElementTree as ET
-    def parse_xml(text):
-        return ET.fromstring(text)
+from .xmlparser import parse_xml, IncrementalParser, ParseError, \
+    XMLLimitExceeded
+import asyncio, json, logging
 
 # try to avoid some unnecessary conversions, though perhaps
 # this really belongs in some Channels middleware
@@ -31,20 +32,26 @@ class proxy_ssl_header_cache:
         return proxy_header
 proxy_ssl = proxy_ssl_header_cache()
 
-def get_scope_secure(scope, secure_scheme):
+def get_scope_secure(scope, secure_scheme, headers=None):
+    # headers may be a dict of the scope's headers, if the caller has one
     proxy_header = proxy_ssl.header
     if proxy_header:
-        for hdr, val in scope['headers']:
-            if hdr == proxy_header:
-                value = val.decode()
-                return (value == secure_scheme or
-                        value == django_settings.SECURE_PROXY_SSL_HEADER[1])
-        return False
+        if headers is None:
+            headers = dict(scope['headers'])
+        val = headers.get(proxy_header)
+        if val is None:
+            return False
+        value = val.decode()
+        return (value == secure_scheme or
+                value == django_settings.SECURE_PROXY_SSL_HEADER[1])
     return scope['scheme'] == secure_scheme
 
 async def get_scope_user(scope):
     if not settings.ALLOW_WEBUSER_LOGIN:
         return None
+    return await get_scope_webuser(scope)
+
+async def get_scope_webuser(scope):
     if 'user' not in scope:
         # run middleware stack on the current scope,
         # so we can find the logged-in user.
@@ -65,6 +72,9 @@ def get_origin(scope):
             return value
     return None
 
+# the answer only depends on the settings, and browsers
+# keep sending the same few origins over and over
+@lru_cache(maxsize=256)
 def is_trusted_origin(origin):
     if not settings.ALLOW_WEBUSER_LOGIN:
         return False
@@ -79,27 +89,73 @@ def is_trusted_origin(origin):
     except UnicodeDecodeError:
         return False
 
+def get_forwarded_for(scope):
+    # the client address added by a reverse proxy, if one is configured
+    header = settings.FORWARDED_FOR_HEADER
+    if not header:
+        return None
+    header = header.lower().encode()
+    for hdr, value in scope['headers']:
+        if hdr == header:
+            # the last entry is the one added by our own proxy,
+            # the rest came from the client and can't be trusted
+            host = value.decode('latin1').rsplit(',', 1)[-1].strip()
+            return host or None
+    return None
+
 def get_addr(scope):
-    # TODO: check proxy headers
     client = scope['client']
+    host = get_forwarded_for(scope)
+    if host is not None:
+        # the client's port isn't passed on
+        return host
     return format_addr(client[0], client[1])
 
+def get_client_host(scope):
+    host = get_forwarded_for(scope)
+    if host is not None:
+        return host
+    return scope['client'][0]
+
+bosh_logger = logging.getLogger('xmppserver.transport.bosh')
+
 class BOSHConsumer(AsyncConsumer):
+    # A new consumer is created for every BOSH request,
+    # so do as little as possible until it's needed.
     def __init__(self, scope):
         super(BOSHConsumer, self).__init__(scope)
-        self.logger = logging.LoggerAdapter(
-            logging.getLogger('xmppserver.transport.bosh'),
-            {'client': get_addr(scope)})
-        self.parts = []
+        self.headers = headers = dict(scope['headers'])
+        self.http_host = headers.get(b'host')
+        self.http_origin = headers.get(b'origin')
+        self.parser = None
+        self.rejected = False
         self.stream = None
+        self.forward_task = None
+        self.forwarded = None
         self.rid = None
         self.answered = False
-        self.http_host = get_host(scope)
-        self.http_origin = get_origin(scope)
-        self.loop = asyncio.get_event_loop()
+        self._logger = None
+        self._loop = None
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            self._logger = logging.LoggerAdapter(
+                bosh_logger, {'client': get_addr(self.scope)})
+        return self._logger
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    @property
+    def client_host(self):
+        return get_client_host(self.scope)
 
     def is_secure(self):
-        return get_scope_secure(self.scope, 'https')
+        return get_scope_secure(self.scope, 'https', self.headers)
 
     def is_trusted(self):
         return is_trusted_origin(self.http_origin)
@@ -119,29 +175,49 @@ class BOSHConsumer(AsyncConsumer):
         })
 
     async def send_data(self, data, headers):
-        text = str(data)
-        self.logger.debug('Send sid="%s" rid="%s": %s',
-                          self.stream.sid, self.rid,
-                          text)
-        await self.send_response(headers,
-                                 text.encode('utf8'))
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        if bosh_logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Send sid="%s" rid="%s": %s',
+                              self.stream and self.stream.sid, self.rid,
+                              data)
+        encoding = get_content_encoding(self.headers.get(b'accept-encoding'))
+        data, headers = compress_body(data, headers, encoding)
+        await self.send_response(headers, data)
 
     async def receive_bosh(self, event):
-        self.parts.append(event['body'])
-        if event.get('more_body', False):
+        # The body is parsed as it arrives, so it's never held in
+        # memory as a whole, and oversized bodies are turned away
+        # without reading all of them first.
+        if self.rejected:
             return
-        body = b''.join(self.parts)
-        self.parts = None
-
-        self.logger.debug('Receive: %s', body)
-        xml = parse_xml(body)
-        await handle_bosh(self, xml)
+        if self.parser is None:
+            self.parser = IncrementalParser(settings.BOSH_MAX_BODY_SIZE,
+                                            settings.BOSH_MAX_BODY_DEPTH)
+        data = event['body']
+        if bosh_logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Receive: %s', data)
+        try:
+            self.parser.feed(data)
+            if event.get('more_body', False):
+                return
+            xml = self.parser.close()
+        except XMLLimitExceeded as e:
+            self.logger.warning('Rejecting request: %s', e)
+            self.rejected = True
+            await self.send_response(status=413)
+            return
+        except (ParseError, ValueError) as e:
+            self.logger.warning('Invalid request: %s', e)
+            self.rejected = True
+            await self.send_response(status=400)
+            return
+        size = self.parser.size
+        self.parser = None
+        await handle_bosh(self, xml, size)
 
     async def request_options(self):
-        access_method = None
-        for hdr, value in self.scope['headers']:
-            if hdr == b'access-control-request-method':
-                access_method = value
+        access_method = self.headers.get(b'access-control-request-method')
         if access_method is not None:
             # CORS preflight request
             self.logger.debug('CORS preflight request, origin %s',
@@ -184,6 +260,7 @@ class WSConsumer(AsyncConsumer):
             logging.getLogger('xmppserver.transport.websockets'),
             {'client': get_addr(scope)})
         self.stream = None
+        self.framing = None
         self.http_host = get_host(scope)
         self.http_origin = get_origin(scope)
         self.loop = asyncio.get_event_loop()
@@ -206,29 +283,120 @@ class WSConsumer(AsyncConsumer):
     async def send_data(self, data):
         text = str(data)
         self.logger.debug('Send: %s', text)
-        await self.send({
-            'type': 'websocket.send',
-            'text': text,
-        })
+        msg = self.framing.encode(text)
+        msg['type'] = 'websocket.send'
+        await self.send(msg)
 
     async def websocket_connect(self, event):
         subprotos = self.scope.get('subprotocols', None)
-        if subprotos and 'xmpp' in subprotos:
+        if not admit_connection(get_client_host(self.scope)):
+            self.logger.warning('Connection rate exceeded, refusing connection')
+            await self.close_socket()
+            return
+        self.framing = select_framing(subprotos or [])
+        if self.framing:
             self.logger.debug('Connected')
             await self.send({
                 'type': 'websocket.accept',
-                'subprotocol': 'xmpp',
+                'subprotocol': self.framing.subprotocol,
             })
         else:
             await self.close_socket()
 
     async def websocket_receive(self, event):
-        text = event['text']
+        try:
+            text = self.framing.decode(event)
+        except ValueError as e:
+            self.logger.warning('Invalid message: %s', e)
+            await self.close_socket()
+            return
         self.logger.debug('Receive: %s', text)
         xml = parse_xml(text)
-        await handle_ws(self, xml)
+        size = len(event.get('bytes') or event.get('text'))
+        await handle_ws(self, xml, size)
 
     async def websocket_disconnect(self, event):
         self.logger.debug('Disconnected')
         await disconnect_ws(self)
         raise StopConsumer()
+
+class ScopeRequest(object):
+    # just enough of an HttpRequest for get_chat_domain()
+    def __init__(self, host):
+        self.host = host
+
+    def get_host(self):
+        return self.host
+
+@database_sync_to_async
+def get_prebind_params(user, host):
+    # same checks as prebind_view
+    if user is not None and user.is_authenticated:
+        username = get_hook('auth').get_webuser_username(user)
+    elif settings.ALLOW_ANONYMOUS_LOGIN:
+        username = None
+    else:
+        raise PermissionDenied()
+    domain = get_chat_domain(ScopeRequest(host))
+    return username, domain
+
+class PrebindConsumer(AsyncConsumer):
+    # Does the same as prebind_view, but creates the BOSH stream on
+    # the event loop that's going to serve its requests, instead of
+    # a temporary one, and without tying up a thread while doing it.
+    def __init__(self, scope):
+        super(PrebindConsumer, self).__init__(scope)
+        self.logger = logging.LoggerAdapter(
+            logging.getLogger('xmppserver.transport.bosh'),
+            {'client': get_addr(scope)})
+
+    async def send_response(self, headers=[], body=b'', status=200):
+        await self.send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await self.send({
+            'type': 'http.response.body',
+            'body': body,
+        })
+
+    async def prebind(self):
+        host = get_host(self.scope)
+        if host is None:
+            await self.send_response(status=400)
+            return
+        host = host.decode('latin1')
+        # set by the AuthMiddlewareStack the route is wrapped in
+        user = self.scope.get('user')
+        try:
+            username, domain = await get_prebind_params(user, host)
+        except PermissionDenied:
+            await self.send_response(status=403)
+            return
+        origin = get_origin(self.scope)
+        if origin is None:
+            scheme = 'https://' if get_scope_secure(self.scope, 'https') \
+                     else 'http://'
+            origin = (scheme + host).encode('latin1')
+        if settings.SERVER:
+            host = settings.SERVER
+        self.logger.debug('Prebind request')
+        data = await prebind_bosh_stream(user,
+                                         username=username,
+                                         domain=domain,
+                                         host=host.encode('latin1'),
+                                         origin=origin)
+        await self.send_response([(b'content-type', b'application/json')],
+                                 json.dumps(data).encode('utf8'))
+
+    async def http_request(self, event):
+        if event.get('more_body', False):
+            return
+        if self.scope['method'] in ('GET', 'POST'):
+            await self.prebind()
+        else:
+            await self.send_response(status=405)
+
+    async def http_disconnect(self, event):
+        raise StopConsumer()
@@ -0,0 +1,94 @@
+from .conf import settings
+import zlib
+
+# WebSocket framing. RFC 7395 puts every XMPP element in a text message
+# of its own, under the "xmpp" subprotocol. Other framings can be
+# installed with set_framing(), under subprotocols of their own; the
+# first subprotocol offered by the client that has an enabled framing
+# is used.
+
+# what deflate leaves at the end of a sync flush
+SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+class TextFraming(object):
+    subprotocol = 'xmpp'
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def encode(self, text):
+        # returns the websocket.send message fields
+        return {'text': text}
+
+    def decode(self, event):
+        # returns the text of a websocket.receive message,
+        # raises ValueError if it's unacceptable
+        text = event.get('text')
+        if text is None:
+            text = event['bytes'].decode('utf8')
+        if len(text) > settings.WEBSOCKETS_MAX_MESSAGE_SIZE:
+            raise ValueError('message is larger than %d bytes' %
+                             settings.WEBSOCKETS_MAX_MESSAGE_SIZE)
+        return text
+
+class DeflateFraming(TextFraming):
+    # Every message is compressed and sent as a binary message. Since
+    # not every ASGI server supports permessage-deflate (RFC 7692), this
+    # does much the same thing at the application level: the payloads
+    # are raw deflate data, with the sync flush tail removed, and the
+    # compression context carried over from one message to the next.
+    # Clients may send either compressed binary or plain text messages.
+    # This is not a standard subprotocol, so only clients that know
+    # about it will ask for it.
+    subprotocol = 'xmpp-deflate'
+
+    @classmethod
+    def enabled(cls):
+        return settings.WEBSOCKETS_DEFLATE
+
+    def __init__(self):
+        wbits = settings.WEBSOCKETS_DEFLATE_WINDOW
+        self.compressor = zlib.compressobj(settings.WEBSOCKETS_DEFLATE_LEVEL,
+                                           zlib.DEFLATED, -wbits)
+        self.decompressor = zlib.decompressobj(-wbits)
+
+    def encode(self, text):
+        data = self.compressor.compress(text.encode('utf8'))
+        data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return {'bytes': data[:-4]}
+
+    def decode(self, event):
+        data = event.get('bytes')
+        if data is None:
+            return super(DeflateFraming, self).decode(event)
+        max_size = settings.WEBSOCKETS_MAX_MESSAGE_SIZE
+        try:
+            data = self.decompressor.decompress(data + SYNC_FLUSH_TAIL,
+                                                max_size + 1)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if len(data) > max_size:
+            raise ValueError('message is larger than %d bytes' % max_size)
+        return data.decode('utf8')
+
+framings = {}
+
+def set_framing(framing):
+    """
+    Install a WebSocket framing, for the subprotocol named
+    by its ``subprotocol`` attribute.
+
+    :param framing: Framing class
+    """
+    framings[framing.subprotocol] = framing
+
+def select_framing(subprotocols):
+    for subprotocol in subprotocols:
+        framing = framings.get(subprotocol)
+        if framing is not None and framing.enabled():
+            return framing()
+    return None
+
+set_framing(TextFraming)
+set_framing(DeflateFraming)
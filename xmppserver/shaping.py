@@ -0,0 +1,99 @@
+from .conf import settings
+import time
+
+# Admission control and traffic shaping
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def update(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def consume(self, amount=1):
+        # The bucket may go into debt, which delay() tells
+        # the caller how long it will take to pay back.
+        self.update()
+        self.tokens -= amount
+
+    def try_consume(self, amount=1):
+        if self.update() < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def delay(self):
+        tokens = self.update()
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+def make_bucket(rate, burst):
+    if not rate:
+        return None
+    return TokenBucket(rate, burst)
+
+class ConnectionLimiter(object):
+    # forget addresses whose buckets have been full for this long
+    prune_interval = 60
+
+    def __init__(self):
+        self.buckets = {}
+        self.pruned = time.monotonic()
+
+    def admit(self, host):
+        rate = settings.LIMIT_CONNECTION_RATE
+        if not rate:
+            return True
+        now = time.monotonic()
+        if now - self.pruned > self.prune_interval:
+            self.prune(now)
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(rate, settings.LIMIT_CONNECTION_BURST)
+            self.buckets[host] = bucket
+        return bucket.try_consume()
+
+    def prune(self, now):
+        self.pruned = now
+        self.buckets = {host: bucket
+                        for host, bucket in self.buckets.items()
+                        if bucket.update() < bucket.burst}
+
+# shared by all transports, so the limit
+# applies to the sum of their connections
+connection_limiter = ConnectionLimiter()
+
+def admit_connection(host):
+    return connection_limiter.admit(host)
+
+class StreamShaper(object):
+    def __init__(self):
+        self.stanzas = make_bucket(settings.LIMIT_STANZA_RATE,
+                                   settings.LIMIT_STANZA_BURST)
+        self.bytes = make_bucket(settings.LIMIT_BYTE_RATE,
+                                 settings.LIMIT_BYTE_BURST)
+
+    def count_stanza(self):
+        if self.stanzas:
+            self.stanzas.consume()
+
+    def count_bytes(self, size):
+        if self.bytes:
+            self.bytes.consume(size)
+
+    def delay(self):
+        # how long to wait before reading more from the client
+        delay = 0
+        if self.stanzas:
+            delay = self.stanzas.delay()
+        if self.bytes:
+            delay = max(delay, self.bytes.delay())
+        return delay
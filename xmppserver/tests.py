@@ -0,0 +1,163 @@
+import asyncio, json, logging
+from unittest import skipIf
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+import channels
+from .xmlparser import ParseError, make_pull_parser, parse_xml
+from .xmpp.bosh import disconnect_bosh, handle_bosh, load_monitor
+
+class PullParserTests(SimpleTestCase):
+    def test_error_raised_from_read_events(self):
+        # like XMLPullParser, feed() must not raise; the events
+        # parsed before the error come first, then the error
+        parser = make_pull_parser()
+        parser.feed(b'<a><b></a>')
+        events = parser.read_events()
+        self.assertEqual([(event, elem.tag) for event, elem in
+                          [next(events), next(events)]],
+                         [('start', 'a'), ('start', 'b')])
+        with self.assertRaises(ParseError):
+            next(events)
+
+# the consumers are written against the Channels 2 interface
+@skipIf(int(channels.__version__.split('.')[0]) > 2,
+        'requires Channels 2')
+class PrebindConsumerTests(TestCase):
+    def request(self, path, headers=()):
+        from channels.routing import URLRouter
+        from .urls import http_urls
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'scheme': 'http',
+            'query_string': b'',
+            'headers': [(b'host', b'localhost')] + list(headers),
+            'client': ('127.0.0.1', 12345),
+        }
+        async def communicate():
+            communicator = ApplicationCommunicator(URLRouter(http_urls),
+                                                   scope)
+            await communicator.send_input({'type': 'http.request',
+                                           'body': b''})
+            response = await communicator.receive_output(5)
+            body = await communicator.receive_output(5)
+            await communicator.wait()
+            return response['status'], body['body']
+        return async_to_sync(communicate)()
+
+    @override_settings(XMPP_ALLOW_ANONYMOUS_LOGIN=False)
+    def test_anonymous_forbidden(self):
+        # the route must supply the user, without it the consumer
+        # has no way to tell who's logged in
+        status, body = self.request('/prebind/')
+        self.assertEqual(status, 403)
+
+    def test_logged_in(self):
+        from django.contrib.auth import get_user_model, SESSION_KEY, \
+            BACKEND_SESSION_KEY, HASH_SESSION_KEY
+        from django.contrib.sessions.backends.db import SessionStore
+        user = get_user_model().objects.create_user('alice')
+        session = SessionStore()
+        session[SESSION_KEY] = user.pk
+        session[BACKEND_SESSION_KEY] = \
+            'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        cookie = ('sessionid=%s' % session.session_key).encode('latin1')
+        status, body = self.request('/prebind/', [(b'cookie', cookie)])
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(body)['jid'].startswith('alice@'))
+
+class BOSHTestConsumer(object):
+    # what handle_bosh needs of a BOSHConsumer, without the HTTP
+    def __init__(self, loop):
+        self.logger = logging.LoggerAdapter(
+            logging.getLogger('xmppserver.transport.bosh'),
+            {'client': 'test'})
+        self.loop = loop
+        self.client_host = '127.0.0.1'
+        self.http_host = b'localhost'
+        self.http_origin = None
+        self.stream = None
+        self.forward_task = None
+        self.rid = None
+        self.answered = False
+        self.responses = []
+
+    def is_trusted(self):
+        return False
+
+    async def get_user(self):
+        return None
+
+    async def send_response(self, headers=[], body=b'', status=200):
+        self.responses.append(body)
+
+    async def send_data(self, data, headers):
+        self.responses.append(data)
+
+class HeldRequestsTests(SimpleTestCase):
+    body = ("<body xmlns='http://jabber.org/protocol/httpbind' "
+            "xmlns:xmpp='urn:xmpp:xbosh' rid='%d' %s/>")
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.held = load_monitor.held
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    async def request(self, rid, attrs):
+        consumer = BOSHTestConsumer(self.loop)
+        await handle_bosh(consumer, parse_xml(self.body % (rid, attrs)))
+        # let the stream get to it
+        for i in range(10):
+            await asyncio.sleep(0)
+        return consumer
+
+    async def start_session(self):
+        # returns the stream, and two held requests
+        consumer = await self.request(1, "to='localhost' wait='60' "
+                                         "hold='2' xmpp:version='1.0'")
+        stream = consumer.stream
+        self.assertEqual(len(consumer.responses), 1)
+        attrs = "sid='%s'" % stream.sid
+        held = [await self.request(2, attrs), await self.request(3, attrs)]
+        self.assertEqual(load_monitor.held, self.held + 2)
+        return stream, held
+
+    def run_session(self, coro):
+        async def run():
+            stream, held = await self.start_session()
+            await coro(stream, held)
+            self.assertEqual(load_monitor.held, self.held)
+            stream.connection_lost()
+        self.loop.run_until_complete(run())
+
+    def test_terminate(self):
+        async def terminate(stream, held):
+            await self.request(4, "sid='%s' type='terminate'" % stream.sid)
+            self.assertTrue(stream.dead)
+        self.run_session(terminate)
+
+    def test_expire(self):
+        async def expire(stream, held):
+            # as the wait timeouts do
+            for consumer in held:
+                stream.expire_request(consumer)
+        self.run_session(expire)
+
+    def test_disconnect(self):
+        async def disconnect(stream, held):
+            for consumer in held:
+                await disconnect_bosh(consumer)
+        self.run_session(disconnect)
+
+    def test_connection_lost(self):
+        async def connection_lost(stream, held):
+            stream.connection_lost()
+        self.run_session(connection_lost)
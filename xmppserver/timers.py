@@ -0,0 +1,97 @@
+import asyncio, logging, math, weakref
+
+logger = logging.getLogger('xmppserver.timers')
+
+# A hashed timing wheel, for the many long, mostly cancelled timeouts
+# that sessions need (e.g. BOSH wait and inactivity timeouts). Arming
+# and cancelling a timer is O(1), and the event loop only ever sees a
+# single timer per wheel, ticking once per resolution while any timers
+# are armed. Timers never fire early, but may fire up to one resolution
+# late.
+
+class Timer(object):
+    __slots__ = ('wheel', 'tick', 'callback', 'args')
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel.remove(self)
+
+    def cancelled(self):
+        return self.wheel is None
+
+class TimerWheel(object):
+    def __init__(self, loop, resolution=1.0, size=512):
+        self.loop = loop
+        self.resolution = resolution
+        self.size = size
+        self.slots = [set() for i in range(size)]
+        self.count = 0
+        self.tick = 0
+        self.start = None
+        self.handle = None
+
+    def call_later(self, delay, callback, *args):
+        # Same interface as loop.call_later, except that the
+        # returned timer supports only cancel() and cancelled().
+        if self.handle is None:
+            self._start()
+        tick = math.ceil((self.loop.time() + delay - self.start) /
+                         self.resolution)
+        timer = Timer(self, max(tick, self.tick + 1), callback, args)
+        self.slots[timer.tick % self.size].add(timer)
+        self.count += 1
+        return timer
+
+    def remove(self, timer):
+        self.slots[timer.tick % self.size].discard(timer)
+        timer.wheel = None
+        self.count -= 1
+        if not self.count and self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _start(self):
+        # line up the ticks with the current time
+        self.start = self.loop.time() - self.tick * self.resolution
+        self._schedule()
+
+    def _schedule(self):
+        self.handle = self.loop.call_at(
+            self.start + (self.tick + 1) * self.resolution,
+            self._advance)
+
+    def _advance(self):
+        self.handle = None
+        self.tick += 1
+        slot = self.slots[self.tick % self.size]
+        # timers more than one revolution away stay where they are
+        expired = [timer for timer in slot if timer.tick <= self.tick]
+        for timer in expired:
+            slot.discard(timer)
+            timer.wheel = None
+            self.count -= 1
+        if self.count:
+            self._schedule()
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception('Error in timer callback %r', timer.callback)
+
+# one wheel per event loop
+wheels = weakref.WeakKeyDictionary()
+
+def get_timer_wheel(loop=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    wheel = wheels.get(loop)
+    if wheel is None:
+        wheel = TimerWheel(loop)
+        wheels[loop] = wheel
+    return wheel
@@ -0,0 +1,166 @@
+from twisted.internet import reactor, ssl
+from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet.endpoints import TCP6ServerEndpoint
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from zope.interface import implementer
+from .xmpp.tcp import TCPStream
+from .conf import settings
+from .shaping import admit_connection
+from .utils import format_addr
+from .xmpp_server import create_reuse_port_socket
+import logging, socket
+
+@implementer(IPushProducer)
+class XMPPServer(Protocol):
+    def __init__(self, factory):
+        self.stream = None
+        self.factory = factory
+        self.logger = factory.logger
+        self.client = None
+
+    def connectionMade(self):
+        try:
+            peer = self.transport.getPeer()
+            self.client = format_addr(peer.host, peer.port)
+            self.logger = logging.LoggerAdapter(self.factory.logger,
+                                                {'client': self.client})
+            self.logger.info('Connected')
+            self.stream = TCPStream(self)
+            # get told when the client isn't reading fast enough
+            self.transport.registerProducer(self, True)
+        except:
+            self.logger.exception('Error opening stream')
+            raise
+
+    def dataReceived(self, data):
+        if self.stream:
+            try:
+                self.logger.debug('Receive: %s', data)
+                self.stream.data_received(data)
+            except:
+                self.logger.exception('Error processing data')
+                raise
+
+    def connectionLost(self, reason=None):
+        if self.stream:
+            try:
+                self.logger.info('Disconnected')
+                self.stream.connection_lost()
+            except:
+                self.logger.exception('Error closing stream')
+                raise
+            self.stream = None
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        if self.stream:
+            self.stream.pause_writing()
+
+    def resumeProducing(self):
+        if self.stream:
+            self.stream.resume_writing()
+
+    def stopProducing(self):
+        pass
+
+    # interface used by TCPStream
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.loseConnection()
+
+    def abort(self):
+        self.transport.abortConnection()
+
+    def pause_reading(self):
+        self.transport.pauseProducing()
+
+    def resume_reading(self):
+        if self.transport.connected:
+            self.transport.resumeProducing()
+
+    def start_tls(self, options):
+        self.transport.startTLS(options)
+
+    def get_peer_certificate(self):
+        return self.transport.getPeerCertificate()
+
+def load_tls_options(logger):
+    # The options (and the OpenSSL context they create) are shared by
+    # all connections and listeners, so the TLS session cache is too.
+    authorities = []
+    if settings.TLS_CACERT_PATHS:
+        for path in settings.TLS_CACERT_PATHS:
+            pub_key = open(path).read()
+            authorities.append(ssl.Certificate.loadPEM(pub_key))
+    if settings.TLS_CERT_PATH and settings.TLS_PRIV_KEY_PATH:
+        try:
+            priv_key = open(settings.TLS_PRIV_KEY_PATH).read()
+            pub_key = open(settings.TLS_CERT_PATH).read()
+            priv_cert = ssl.PrivateCertificate.loadPEM(priv_key + pub_key)
+        except IOError:
+            logger.exception("Couldn't load XMPP server certificate, TLS disabled")
+            return None
+        options = dict(privateKey=priv_cert.privateKey.original,
+                       certificate=priv_cert.original,
+                       enableSessions=settings.TLS_SESSION_RESUMPTION,
+                       enableSessionTickets=settings.TLS_SESSION_RESUMPTION)
+        if authorities:
+            options['trustRoot'] = ssl.trustRootFromCertificates(authorities)
+        return ssl.CertificateOptions(**options)
+    else:
+        logger.warning('XMPP server certificate not configured, TLS disabled')
+        return None
+
+class XMPPServerFactory(ServerFactory):
+    def __init__(self, logger, options, direct_tls=False):
+        super(XMPPServerFactory, self).__init__()
+        self.logger = logger
+        self.options = options
+        self.direct_tls = direct_tls
+
+    def buildProtocol(self, addr):
+        if not admit_connection(addr.host):
+            self.logger.warning('Connection rate exceeded, refusing connection from %s',
+                                format_addr(addr.host, addr.port))
+            return None
+        return XMPPServer(self)
+
+class DirectTLSFactory(TLSMemoryBIOFactory):
+    # TLSMemoryBIOFactory can't handle refused connections
+    def buildProtocol(self, addr):
+        protocol = self.wrappedFactory.buildProtocol(addr)
+        if protocol is None:
+            return None
+        return self.protocol(self, protocol)
+
+def listen_tcp(port, factory):
+    if settings.TCP_REUSE_PORT:
+        sock = create_reuse_port_socket(port)
+        # adoptStreamPort duplicates the file descriptor,
+        # so we can close our copy of it afterwards
+        listener = reactor.adoptStreamPort(sock.fileno(),
+                                           socket.AF_INET6,
+                                           factory)
+        sock.close()
+        return listener
+    c_endpoint = TCP6ServerEndpoint(reactor, port)
+    return c_endpoint.listen(factory)
+
+def start_server(logger):
+    options = load_tls_options(logger)
+    if options is None and settings.TCP_REQUIRE_TLS:
+        raise Exception("XMPP_TCP_REQUIRE_TLS is True, but XMPP server certificate not available")
+    listen_tcp(settings.TCP_CLIENT_PORT,
+               XMPPServerFactory(logger, options))
+    if settings.TCP_DIRECT_TLS_PORT:
+        if options is None:
+            raise Exception("XMPP_TCP_DIRECT_TLS_PORT is set, but XMPP server certificate not available")
+        factory = XMPPServerFactory(logger, options, direct_tls=True)
+        listen_tcp(settings.TCP_DIRECT_TLS_PORT,
+                   DirectTLSFactory(options, False, factory))
+    # should be no need to run the reactor, the ASGI host (Daphne) already does
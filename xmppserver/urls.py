@@ -1,5 +1,6 @@
 from django.conf.urls import url
-from .consumers import BOSHConsumer, WSConsumer
+from channels.auth import AuthMiddlewareStack
+from .consumers import BOSHConsumer, PrebindConsumer, WSConsumer
 from .views import prebind_view, credentials_view, chat_view
 
 app_name = 'xmppserver'
@@ -8,6 +9,9 @@ app_name = 'xmppserver'
 # can choose whichever method works for them
 http_urls = [
     url(r'^bind/$', BOSHConsumer, name='bosh'),
+    # takes over from prebind_view, if this is routed;
+    # needs the logged-in user, like the view does
+    url(r'^prebind/$', AuthMiddlewareStack(PrebindConsumer), name='prebind'),
 ]
 
 ws_urls = [
@@ -20,14 +20,15 @@ def prebind_view(request):
     if origin is None:
         scheme = 'https://' if request.is_secure() else 'http://'
         origin = scheme + host
-    if settings.CHAT_SERVER:
-        host = settings.CHAT_SERVER
+    if settings.SERVER:
+        host = settings.SERVER
+    # the BOSH consumer sees the headers as bytes
     prebind_func = async_to_sync(prebind_bosh_stream)
     data = prebind_func(request.user,
                         username=username,
                         domain=domain,
-                        host=host,
-                        origin=origin)
+                        host=host.encode('latin1'),
+                        origin=origin.encode('latin1'))
     return JsonResponse(data)
 
 def credentials_view(request):
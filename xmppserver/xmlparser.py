@@ -0,0 +1,240 @@
+from .conf import settings
+from functools import lru_cache
+from xml.etree.ElementTree import ParseError, TreeBuilder, XMLParser, \
+    XMLPullParser
+
+try:
+    from defusedxml.ElementTree import DefusedXMLParser
+    from defusedxml import DefusedXmlException
+except ImportError:
+    DefusedXMLParser = None
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# XML parser backends, selected by XMPP_XML_PARSER. Whichever backend is
+# used, the parsed elements are xml.etree elements, which is what slixmpp
+# works with, and documents with a DTD are rejected. XMPP doesn't allow
+# DTDs anyway, and without one, there are no entities to expand and no
+# external resources to fetch. Errors are raised as ParseError.
+# If XMPP_XML_PARSER isn't set, BOSH and WebSocket documents are parsed
+# with defusedxml (if installed), and plain XMPP streams with the
+# standard library's XMLPullParser, which is the fastest for them.
+
+class DTDForbidden(ParseError):
+    pass
+
+class XMLLimitExceeded(ValueError):
+    pass
+
+class SafeTreeBuilder(TreeBuilder):
+    # expat and lxml both tell the target about a DTD before parsing it
+    def doctype(self, name, pubid, system):
+        raise DTDForbidden('document type declarations are not allowed')
+
+class EventTreeBuilder(SafeTreeBuilder):
+    # collects start and end events, like XMLPullParser does
+    # (which only supports a plain TreeBuilder as the target)
+    def __init__(self):
+        super(EventTreeBuilder, self).__init__()
+        self.events = []
+
+    def start(self, tag, attrs):
+        elem = TreeBuilder.start(self, tag, attrs)
+        self.events.append(('start', elem))
+        return elem
+
+    def end(self, tag):
+        elem = TreeBuilder.end(self, tag)
+        self.events.append(('end', elem))
+        return elem
+
+class LxmlTreeBuilder(SafeTreeBuilder):
+    # lxml may pass the attributes as an immutable mapping
+    def start(self, tag, attrs):
+        return SafeTreeBuilder.start(self, tag, dict(attrs))
+
+class LxmlEventTreeBuilder(EventTreeBuilder):
+    def start(self, tag, attrs):
+        return EventTreeBuilder.start(self, tag, dict(attrs))
+
+class PullParser(object):
+    # the parts of XMLPullParser that we (and slixmpp) use,
+    # with start and end events
+    def __init__(self, backend):
+        self.errors = backend.errors
+        self.target = backend.event_builder()
+        self.parser = backend.make_parser(self.target)
+
+    def feed(self, data):
+        # Like XMLPullParser, errors are queued behind the events
+        # parsed before them, and raised from read_events(), since
+        # slixmpp only expects ParseError from there.
+        try:
+            self.parser.feed(data)
+        except ParseError as e:
+            self.target.events.append(e)
+        except self.errors as e:
+            self.target.events.append(ParseError(str(e)))
+
+    def read_events(self):
+        events = self.target.events
+        if events:
+            self.target.events = []
+        for event in events:
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def close(self):
+        try:
+            self.parser.close()
+        except self.errors as e:
+            raise ParseError(str(e))
+
+class ExpatBackend(object):
+    # the standard library's expat parser
+    name = 'expat'
+    tree_builder = SafeTreeBuilder
+    event_builder = EventTreeBuilder
+    errors = ()
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def make_parser(self, target):
+        return XMLParser(target=target)
+
+    def parse(self, text):
+        # returns the root element
+        parser = self.make_parser(self.tree_builder())
+        try:
+            parser.feed(text)
+            return parser.close()
+        except self.errors as e:
+            raise ParseError(str(e))
+
+    def make_pull_parser(self):
+        return PullParser(self)
+
+class DefusedBackend(ExpatBackend):
+    # defusedxml's expat parser, which runs in Python
+    name = 'defusedxml'
+
+    @classmethod
+    def available(cls):
+        return DefusedXMLParser is not None
+
+    @property
+    def errors(self):
+        return DefusedXmlException
+
+    def make_parser(self, target):
+        return DefusedXMLParser(target=target, forbid_dtd=True)
+
+class LxmlBackend(ExpatBackend):
+    # libxml2, with entity resolution and network access turned off,
+    # and its limits on text size and nesting depth left in place,
+    # in case the DTD check isn't reached for some reason
+    name = 'lxml'
+    tree_builder = LxmlTreeBuilder
+    event_builder = LxmlEventTreeBuilder
+
+    @classmethod
+    def available(cls):
+        return lxml_etree is not None
+
+    @property
+    def errors(self):
+        return lxml_etree.LxmlError
+
+    def make_parser(self, target):
+        return lxml_etree.XMLParser(target=target,
+                                    resolve_entities=False,
+                                    no_network=True,
+                                    huge_tree=False,
+                                    load_dtd=False)
+
+backends = {}
+
+def set_xml_backend(backend):
+    """
+    Install an XML parser backend, under the name given
+    by its ``name`` attribute.
+
+    :param backend: Backend class
+    """
+    backends[backend.name] = backend()
+
+def get_xml_backend(default='expat'):
+    name = settings.XML_PARSER or default
+    backend = backends.get(name)
+    if backend is None:
+        raise Exception("Unknown XMPP_XML_PARSER %r" % name)
+    if not backend.available():
+        raise Exception("XMPP_XML_PARSER is %r, but it is not installed" %
+                        name)
+    return backend
+
+# the answer only depends on the settings, and looking up
+# an unset setting costs as much as parsing a small stanza
+@lru_cache(maxsize=1)
+def get_document_backend():
+    # for BOSH bodies and WebSocket messages
+    if DefusedXMLParser is not None:
+        return get_xml_backend('defusedxml')
+    return get_xml_backend()
+
+set_xml_backend(ExpatBackend)
+set_xml_backend(DefusedBackend)
+set_xml_backend(LxmlBackend)
+
+def parse_xml(text):
+    return get_document_backend().parse(text)
+
+def make_pull_parser():
+    # for plain XMPP streams
+    if settings.XML_PARSER is None:
+        return XMLPullParser(('start', 'end'))
+    return get_xml_backend().make_pull_parser()
+
+class IncrementalParser(object):
+    # Parses an XML document as it arrives, a chunk at a time,
+    # enforcing limits on its size and depth along the way.
+    # Raises XMLLimitExceeded or ParseError when something's wrong.
+    def __init__(self, max_size, max_depth):
+        self.parser = get_document_backend().make_pull_parser()
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.size = 0
+        self.depth = 0
+        self.root = None
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise XMLLimitExceeded('document is larger than %d bytes' %
+                                   self.max_size)
+        self.parser.feed(data)
+        self._check_events()
+
+    def close(self):
+        # returns the root element
+        self.parser.close()
+        self._check_events()
+        return self.root
+
+    def _check_events(self):
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                self.depth += 1
+                if self.depth > self.max_depth:
+                    raise XMLLimitExceeded('document is nested deeper than %d'
+                                           ' levels' % self.max_depth)
+            else:
+                self.depth -= 1
+                if not self.depth:
+                    self.root = elem
@@ -1,10 +1,14 @@
 from asyncio import iscoroutine, wrap_future, InvalidStateError
 from concurrent.futures import Future # threadpool-compatible futures
-from slixmpp import Callback, StanzaPath
+from slixmpp import StanzaPath
 from slixmpp.exceptions import XMPPError
+from slixmpp.features.feature_bind import stanza as bind_stanza
 from slixmpp.features.feature_mechanisms import stanza as auth_stanza
-from slixmpp.plugins import xep_0078
-from slixmpp.stanza import StreamFeatures
+from slixmpp.features.feature_session import stanza as session_stanza
+from slixmpp.plugins.xep_0078 import stanza as legacy_stanza
+from slixmpp.stanza import Iq, StreamFeatures
+from slixmpp.xmlstream import register_stanza_plugin
+from .matcher import register_handlers
 from .mechanisms import get_sasl_available, get_sasl_by_name, LegacyAuth
 from ..conf import settings
 import uuid
@@ -12,47 +16,46 @@ import uuid
 # workaround: slixmpp's Failure may reference condition_ns without defining it
 auth_stanza.Failure.condition_ns = auth_stanza.Failure.namespace
 
+# slixmpp's feature plugins are written for clients,
+# we only need their stanza classes
+register_stanza_plugin(StreamFeatures, auth_stanza.Mechanisms)
+register_stanza_plugin(Iq, bind_stanza.Bind)
+register_stanza_plugin(StreamFeatures, bind_stanza.Bind)
+register_stanza_plugin(Iq, session_stanza.Session)
+register_stanza_plugin(StreamFeatures, session_stanza.Session)
+register_stanza_plugin(Iq, legacy_stanza.IqAuth)
+register_stanza_plugin(StreamFeatures, legacy_stanza.AuthFeature)
+
 class Auth(object):
+    handlers = (
+        ('Auth', StanzaPath('auth'), '_handle_auth'),
+        ('Auth Response', StanzaPath('response'), '_handle_response'),
+        ('Auth Abort', StanzaPath('abort'), '_handle_abort'),
+    )
+    legacy_handlers = (
+        ('LegacyAuth', StanzaPath('iq/auth'), '_handle_legacy_auth'),
+    )
+    bind_handlers = (
+        ('Bind', StanzaPath('iq/bind'), '_handle_bind'),
+        ('Session', StanzaPath('iq/session'), '_handle_session'),
+    )
+
     def __init__(self, stream):
         self.stream = stream
         self.auth_task = None
         self.bind_func = None
         self.response_fut = None
         self.responses = None
-        stream.credentials = {} # feature_mechanisms need this
-        stream.register_plugin('feature_mechanisms')
-        stream.register_handler(
-            Callback('Auth',
-                     StanzaPath('auth'),
-                     self._handle_auth))
-        stream.register_handler(
-            Callback('Auth Response',
-                     StanzaPath('response'),
-                     self._handle_response))
-        stream.register_handler(
-            Callback('Auth Abort',
-                     StanzaPath('abort'),
-                     self._handle_abort))
+        stream.register_stanza(auth_stanza.Auth)
+        stream.register_stanza(auth_stanza.Response)
+        stream.register_stanza(auth_stanza.Abort)
+        register_handlers(stream, self, self.handlers)
         if LegacyAuth.available(self):
-            # need to explicitly specify module here since xep_0078
-            # is purposefully unavailable by default
-            stream.register_plugin('xep_0078', module=xep_0078)
-            stream.register_handler(
-                Callback('LegacyAuth',
-                         StanzaPath('iq/auth'),
-                         self._handle_legacy_auth))
-
-        stream.register_plugin('feature_bind')
-        stream.register_handler(
-            Callback('Bind',
-                     StanzaPath('iq/bind'),
-                     self._handle_bind))
+            register_handlers(stream, self, self.legacy_handlers)
 
-        stream.register_plugin('feature_session')
-        stream.register_handler(
-            Callback('Session',
-                     StanzaPath('iq/session'),
-                     self._handle_session))
+        stream.register_feature('bind', None)
+        stream.register_feature('session', None)
+        register_handlers(stream, self, self.bind_handlers)
 
         stream.add_event_handler('disconnected',
                                  self._disconnected)
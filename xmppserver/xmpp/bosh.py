@@ -1,10 +1,21 @@
+from channels.exceptions import ChannelFull
 from random import randint
 from slixmpp import BaseXMPP
-from slixmpp.xmlstream import tostring
+from slixmpp.xmlstream import ElementBase, tostring
+from xml.sax.saxutils import quoteattr
+from .outbound import drop_superseded, presence_key
 from .stream import min_version, StreamElement, Stream
+from ..cluster import get_owner_channel, make_owned_id, node, node_channel
 from ..conf import settings
+from ..shaping import admit_connection
+from ..timers import get_timer_wheel
+from ..xmlparser import parse_xml
+from collections import OrderedDict
+from functools import lru_cache
+import asyncio, logging, zlib
 
 MAX_VER = '1.8'
+NS_HTTPBIND = 'http://jabber.org/protocol/httpbind'
 NS_XBOSH = 'urn:xmpp:xbosh'
 
 # streams handled by this process
@@ -20,12 +31,11 @@ def clear_local_stream(id):
     del streams[id]
 
 xbosh_restart = '{%s}restart' % NS_XBOSH
-xbosh_restartlogic = '{%s}restartlogic' % NS_XBOSH
 xbosh_version = '{%s}version' % NS_XBOSH
 
 class BOSHBody(StreamElement):
     name = 'body'
-    namespace = 'http://jabber.org/protocol/httpbind'
+    namespace = NS_HTTPBIND
     interfaces = {'from', 'to', 'sid', 'version',
                   'type', 'condition'}
     types = {'terminate', None}
@@ -35,6 +45,46 @@ class BOSHBody(StreamElement):
     def set_version(self, value):
         self.xml.attrib[xbosh_version] = value
 
+class PendingBody(object):
+    # A BOSH body waiting to be sent. Stanzas are serialized once, when
+    # they're queued, and the body is put together by concatenating them
+    # between a <body> start tag and end tag, so the stanzas never have
+    # to be serialized again, whatever happens to the body's attributes.
+    # The text is only encoded once, when the body is.
+    prefix = '<body xmlns="%s"' % NS_HTTPBIND
+    empty_start = prefix + '>'
+    end = '</body>'
+
+    def __init__(self):
+        self.attrs = {}
+        self.chunks = [] # (text, key) pairs, see outbound.drop_superseded
+
+    def __setitem__(self, name, value):
+        self.attrs[name] = value
+
+    def append(self, xml, text=None):
+        # text is the stanza already serialized, if available
+        if isinstance(xml, ElementBase):
+            xml = xml.xml
+        if text is None:
+            text = tostring(xml, top_level=True)
+        self.chunks.append((text, presence_key(xml)))
+
+    def serialize(self):
+        if self.attrs:
+            start = self.prefix + ''.join(
+                [' %s=%s' % (name, quoteattr(value))
+                 for name, value in self.attrs.items()])
+            if not self.chunks:
+                return (start + ' />').encode('utf8')
+            start += '>'
+        else:
+            if not self.chunks:
+                return (self.prefix + ' />').encode('utf8')
+            start = self.empty_start
+        return ''.join([start] + [text for text, key in self.chunks] +
+                       [self.end]).encode('utf8')
+
 def build_headers(content=b'text/xml; charset=utf-8',
                   origin=None, trust=False):
     headers = [
@@ -46,13 +96,178 @@ def build_headers(content=b'text/xml; charset=utf-8',
             headers.append((b'access-control-allow-credentials', 'true'))
     return headers
 
+def get_content_encoding(accept_encoding):
+    # Picks gzip or deflate from an Accept-Encoding header, if allowed.
+    if not settings.BOSH_COMPRESSION or accept_encoding is None:
+        return None
+    return negotiate_encoding(accept_encoding)
+
+# browsers send the same header every time
+@lru_cache(maxsize=64)
+def negotiate_encoding(accept_encoding):
+    allowed = set()
+    for item in accept_encoding.lower().split(b','):
+        params = item.split(b';')
+        coding = params[0].strip()
+        q = b'1'
+        for param in params[1:]:
+            name, sep, value = param.partition(b'=')
+            if name.strip() == b'q':
+                q = value.strip()
+        try:
+            if float(q) > 0:
+                allowed.add(coding)
+        except ValueError:
+            pass
+    for coding in (b'gzip', b'deflate'):
+        if coding in allowed:
+            return coding
+    if b'*' in allowed:
+        return b'gzip'
+    return None
+
+def compress_body(data, headers, encoding):
+    # Returns the (data, headers) to actually send.
+    if encoding is None or len(data) < settings.BOSH_COMPRESSION_MIN_SIZE:
+        return data, headers
+    # HTTP's deflate is the zlib format, not raw deflate
+    wbits = 31 if encoding == b'gzip' else 15
+    compressor = zlib.compressobj(settings.BOSH_COMPRESSION_LEVEL,
+                                  zlib.DEFLATED, wbits)
+    data = compressor.compress(data) + compressor.flush()
+    return data, headers + [(b'content-encoding', encoding)]
+
 def get_empty_body():
-    return tostring(BOSHBody().xml, top_level=True)
+    return PendingBody().serialize()
 
 def get_recoverable_body():
-    body = BOSHBody()
+    body = PendingBody()
     body['type'] = 'error'
-    return tostring(body.xml, top_level=True)
+    return body.serialize()
+
+class ReplyCache(object):
+    # Replies are kept until the client acknowledges them, in case
+    # it needs them retransmitted. To keep memory use bounded, each
+    # session, and the process as a whole, has a byte budget; when
+    # it's exceeded, the oldest replies are evicted first.
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def store(self, stream, rid, data):
+        self.discard(stream, rid)
+        stream.replies[rid] = data
+        stream.reply_bytes += len(data)
+        self.entries[(stream, rid)] = len(data)
+        self.size += len(data)
+        # the newest reply is always kept, however large
+        while (stream.reply_bytes > settings.BOSH_REPLY_CACHE_SIZE and
+               len(stream.replies) > 1):
+            self.evict(stream, next(iter(stream.replies)))
+        while (self.size > settings.BOSH_REPLY_CACHE_TOTAL and
+               len(self.entries) > 1):
+            self.evict(*next(iter(self.entries)))
+
+    def evict(self, stream, rid):
+        self.discard(stream, rid)
+        stream.logger.debug('Evicted cached reply for rid %d', rid)
+
+    def discard(self, stream, rid):
+        data = stream.replies.pop(rid, None)
+        if data is not None:
+            stream.reply_bytes -= len(data)
+            self.size -= self.entries.pop((stream, rid))
+
+    def clear(self, stream):
+        for rid in list(stream.replies):
+            self.discard(stream, rid)
+
+reply_cache = ReplyCache()
+
+class LoadMonitor(object):
+    # Estimates how busy this process is, from the number of held
+    # requests and the event loop lag, for adaptive wait and hold.
+    interval = 1.0
+
+    def __init__(self):
+        self.loop = None
+        self.expected = None
+        self.lag = 0.0
+        self.load = 0.0
+        self.held = 0 # requests held by all streams, see HeldRequests
+
+    def start(self, loop):
+        if self.loop is None:
+            self.loop = loop
+            self._schedule()
+
+    def _schedule(self):
+        self.expected = self.loop.time() + self.interval
+        self.loop.call_at(self.expected, self._probe)
+
+    def _probe(self):
+        lag = max(self.loop.time() - self.expected, 0.0)
+        # react to lag spikes at once, but calm down gradually
+        self.lag = max(lag, (self.lag + lag) / 2)
+        self.load = min(max(self.held / settings.BOSH_ADAPTIVE_MAX_HELD,
+                            self.lag / settings.BOSH_ADAPTIVE_MAX_LAG), 1.0)
+        self._schedule()
+
+    def adapt_wait(self, wait):
+        # somewhere between the requested wait and the minimum
+        if wait <= settings.BOSH_MIN_WAIT:
+            return wait
+        return wait - int((wait - settings.BOSH_MIN_WAIT) * self.load)
+
+    def adapt_hold(self, hold):
+        # somewhere between the requested hold and one
+        if hold <= 1:
+            return hold
+        return hold - int((hold - 1) * self.load + 0.5)
+
+load_monitor = LoadMonitor()
+
+class HeldRequests(object):
+    # A stream's held requests (consumers), by rid, keeping the load
+    # monitor's count of held requests up to date as they come and
+    # go, so it doesn't have to count them all every time. Requests
+    # must only be added and removed through the methods below.
+    def __init__(self):
+        self.consumers = {}
+
+    def __len__(self):
+        return len(self.consumers)
+
+    def __contains__(self, rid):
+        return rid in self.consumers
+
+    def get(self, rid):
+        return self.consumers.get(rid)
+
+    def values(self):
+        return self.consumers.values()
+
+    def add(self, rid, consumer):
+        if rid not in self.consumers:
+            load_monitor.held += 1
+        self.consumers[rid] = consumer
+
+    def remove(self, rid):
+        # returns the consumer, or None if there wasn't one
+        consumer = self.consumers.pop(rid, None)
+        if consumer is not None:
+            load_monitor.held -= 1
+        return consumer
+
+    def pop_oldest(self):
+        # returns (rid, consumer) for the request
+        # that has been held the longest
+        rid = next(iter(self.consumers))
+        return rid, self.remove(rid)
+
+    def clear(self):
+        load_monitor.held -= len(self.consumers)
+        self.consumers.clear()
 
 class BOSHStream(Stream):
     empty_body = get_empty_body()
@@ -61,9 +276,10 @@ class BOSHStream(Stream):
     def __init__(self):
         super(BOSHStream, self).__init__()
         self.update_logger({'transport': 'BOSH'})
-        self.consumers = {}
+        self.consumers = HeldRequests()
         self.requests = {}
-        self.replies = {}
+        self.replies = OrderedDict()
+        self.reply_bytes = 0
         self.content_type = b'text/xml; charset=utf-8'
         self.http_host = None
         self.http_origin = None
@@ -77,9 +293,14 @@ class BOSHStream(Stream):
         self.bosh_started = False
         self.bosh_ver = None
         self.bosh_wait = None
+        self.bosh_hold = None
+        self.client_wait = None
+        self.client_hold = None
+        self.last_poll = None
         self.bosh_inactivity = settings.BOSH_MAX_INACTIVITY
         self.inactivity_handle = None
         self.dead = False
+        self.terminated = False
         self.restarting = False
         self.frozen = 0
         self.add_event_handler('auth_success',
@@ -89,16 +310,19 @@ class BOSHStream(Stream):
         self.logger.debug('Prebinding BOSH, username %s', username)
         if not self.host:
             self.host = host
+        # newer slixmpp versions want the domain set first
+        self.boundjid.domain = self.host
         if username is not None:
             self.boundjid.user = username
+            # the auth hook needs to know the user when binding
+            await self.auth_hook.check_webuser(self, self.web_user, username)
         else:
             self.boundjid.user = await self.auth.generate_anonymous_user()
-        self.boundjid.domain = self.host
         if resource is not None:
             self.boundjid.resource = resource
         else:
             self.boundjid.resource = await self.auth.generate_resource_id()
-        self.sid = self.generate_id()
+        self.sid = await self.generate_sid()
         self.update_logger({'sid': self.sid,
                             'jid': self.boundjid.full})
 
@@ -111,18 +335,14 @@ class BOSHStream(Stream):
 
         self.logger.info('BOSH session prebound for JID %s', self.boundjid.full)
 
-        # prebind may be done from a different event loop than the
-        # actual BOSH requests, so reset the cached loop property
-        # (perhaps we should make sure it's not cached at all?)
-        #self._loop = None
-
-        # TODO: verify that the session timeout installed above
-        # actually works despite the different event loops;
-        # perhaps we should make an ASGI consumer for prebinding?
+        # PrebindConsumer calls us on the event loop that will serve
+        # the BOSH requests. But prebind_view has to use a temporary
+        # event loop, so if it's used instead, self.loop and the session
+        # timeout installed above may not be of much use afterwards.
 
         data = {'jid': self.boundjid.full,
                 'sid': self.sid,
-                'rid': self.rid}
+                'rid': self.rid_in}
         return data
 
     def start_stream_handler(self, xml):
@@ -139,12 +359,20 @@ class BOSHStream(Stream):
         self.use_ack = 'ack' in attrs
         self.bosh_started = True
         self.bosh_ver = min_version(attrs.get('ver', '1.0'), MAX_VER)
-        # TODO: polling-only clients
-        self.bosh_wait = min(max(int(attrs.get('wait', '60')),
-                                 settings.BOSH_MIN_WAIT),
-                             settings.BOSH_MAX_WAIT)
-        self.bosh_hold = min(int(attrs.get('hold', '1')),
-                             settings.BOSH_MAX_HOLD)
+        self.client_wait = min(max(int(attrs.get('wait', '60')),
+                                   settings.BOSH_MIN_WAIT),
+                               settings.BOSH_MAX_WAIT)
+        self.client_hold = min(max(int(attrs.get('hold', '1')), 0),
+                               settings.BOSH_MAX_HOLD)
+        self.bosh_wait = self.client_wait
+        self.bosh_hold = self.client_hold
+        if settings.BOSH_ADAPTIVE:
+            load_monitor.start(self.loop)
+            self.bosh_wait = self.get_wait()
+            self.bosh_hold = self.get_hold()
+        if self.bosh_hold == 0:
+            # polling session, every request is answered right away
+            self.logger.debug('Polling session')
         self.bosh_requests = self.bosh_hold + 1
         if not self.host and 'to' in attrs:
             self.host = attrs['to']
@@ -167,23 +395,68 @@ class BOSHStream(Stream):
             self.inactivity_handle = None
         if self.sid is not None:
             clear_local_stream(self.sid)
+        reply_cache.clear(self)
+        # requests still held when the stream dies
+        # are no longer counted as held
+        self.consumers.clear()
         super(BOSHStream, self).connection_lost(reason)
 
+    async def generate_sid(self):
+        sid = await self.generate_id()
+        if settings.BOSH_CLUSTER_ROUTING:
+            # tell the other processes where to forward our requests
+            node.start()
+            sid = make_owned_id(sid)
+        return sid
+
+    # These timeouts are rescheduled on almost every request, so
+    # they go on a timer wheel rather than the event loop's heap.
+
     def set_consumer_timeout(self, consumer):
-        consumer.wait_handle = self.loop.call_later(self.bosh_wait, self.expire_request, consumer)
+        consumer.wait_handle = get_timer_wheel(self.loop).call_later(
+            self.get_wait(), self.expire_request, consumer)
 
     def set_session_timeout(self):
-        self.inactivity_handle = self.loop.call_later(self.bosh_inactivity, self.inactive)
+        self.inactivity_handle = get_timer_wheel(self.loop).call_later(
+            self.bosh_inactivity, self.inactive)
+
+    # The wait and hold agreed on at session creation are upper limits,
+    # we're always allowed to answer requests sooner than that. So with
+    # adaptive mode, they're adapted to the current load for every
+    # request, starting from what the client asked for, but a session
+    # never goes above what it was given when it was created.
+
+    def get_wait(self):
+        if settings.BOSH_ADAPTIVE:
+            return min(load_monitor.adapt_wait(self.client_wait),
+                       self.bosh_wait)
+        return self.bosh_wait
+
+    def get_hold(self):
+        if settings.BOSH_ADAPTIVE:
+            return min(load_monitor.adapt_hold(self.client_hold),
+                       self.bosh_hold)
+        return self.bosh_hold
+
+    def is_empty_poll(self, xml):
+        attrs = xml.attrib
+        return (len(xml) == 0 and 'type' not in attrs and
+                'pause' not in attrs and xbosh_restart not in attrs)
 
     def add_consumer(self, consumer, xml):
         rid = int(xml.attrib.get('rid', '1'))
         if rid in self.replies:
             self.send_to_consumer(consumer, self.replies[rid])
             return
+        if self.rid_ack is not None and self.rid_ack <= rid < self.rid_out:
+            # the reply was answered, but has been evicted from the
+            # cache since, so let the client recover as best it can
+            self.send_to_consumer(consumer, self.recoverable_body)
+            return
 
         consumer.rid = rid
         if rid in self.consumers:
-            old_consumer = self.consumers[rid]
+            old_consumer = self.consumers.get(rid)
             self.remove_request(old_consumer)
             old_consumer.rid = None
             self.send_to_consumer(old_consumer, self.recoverable_body)
@@ -193,7 +466,7 @@ class BOSHStream(Stream):
             self.inactivity_handle = None
         if self.bosh_wait:
             self.set_consumer_timeout(consumer)
-        self.consumers[rid] = consumer
+        self.consumers.add(rid, consumer)
 
         if not self.bosh_started:
             return self.start_stream_handler(xml)
@@ -213,7 +486,7 @@ class BOSHStream(Stream):
         if ack >= self.rid_out: # sanity check
             ack = self.rid_out - 1
         while self.rid_ack <= ack:
-            self.replies.pop(self.rid_ack)
+            reply_cache.discard(self, self.rid_ack)
             self.rid_ack += 1
 
         if (rid < self.rid_in or
@@ -221,6 +494,15 @@ class BOSHStream(Stream):
             self.terminate('item-not-found')
             return
 
+        if self.bosh_hold == 0 and self.is_empty_poll(xml):
+            now = self.loop.time()
+            if (self.last_poll is not None and
+                now - self.last_poll < settings.BOSH_POLLING):
+                self.logger.info('Client is polling too frequently')
+                self.terminate('policy-violation')
+                return
+            self.last_poll = now
+
         self.send_freeze()
         self.requests[rid] = xml
         while self.rid_in in self.requests:
@@ -252,8 +534,8 @@ class BOSHStream(Stream):
                                        consumer)
 
     def del_consumer(self, consumer):
-        self.consumers.pop(consumer.rid)
-        if not self.consumers:
+        self.consumers.remove(consumer.rid)
+        if not self.consumers and not self.dead:
             self.set_session_timeout()
 
     def inactive(self):
@@ -282,10 +564,12 @@ class BOSHStream(Stream):
         consumer.loop.create_task(consumer.send_data(data, headers))
 
     def send_to_consumer(self, consumer, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
         headers = self.http_headers
         consumer.answered = True
         if consumer.rid is not None:
-            self.replies[consumer.rid] = data
+            reply_cache.store(self, consumer.rid, data)
         if consumer.loop == self.loop:
             self._send_cb(consumer, data, headers)
             return
@@ -300,7 +584,7 @@ class BOSHStream(Stream):
 
     def flush_requests(self):
         while self.consumers:
-            rid, consumer = self.consumers.popitem()
+            rid, consumer = self.consumers.pop_oldest()
             if self.bosh_wait:
                 consumer.wait_handle.cancel()
             self.send_to_consumer(consumer, self.empty_body)
@@ -308,27 +592,45 @@ class BOSHStream(Stream):
     def send_body_to(self, consumer):
         if self.bosh_wait:
             consumer.wait_handle.cancel()
-        xml = self.current_body.xml
+        body = self.current_body
         self.current_body = None
         ack = self.rid_in - 1
         if ack != consumer.rid:
-            xml.attrib['ack'] = str(ack)
-        data = tostring(xml, top_level=True)
-        self.send_to_consumer(consumer, data)
+            body['ack'] = str(ack)
+        self.send_to_consumer(consumer, body.serialize())
 
     def send_body(self):
-        consumer = self.consumers.pop(self.rid_out, None)
+        consumer = self.consumers.remove(self.rid_out)
         if not consumer:
             return
         self.rid_out += 1
         self.send_body_to(consumer)
+        if self.ipc_paused:
+            self.check_queue()
 
-    def send(self, data):
+    def send(self, data, text=None):
+        if self.terminated:
+            return
         if not self.current_body:
-            self.current_body = BOSHBody()
-        self.current_body.append(data)
+            self.current_body = PendingBody()
+        self.current_body.append(data, text)
         if self.frozen == 0:
             self.send_body()
+        if self.current_body:
+            # nobody to send it to yet
+            self.check_queue()
+
+    def get_queue_depth(self):
+        if not self.current_body:
+            return 0
+        return len(self.current_body.chunks)
+
+    def drop_superseded_presence(self):
+        body = self.current_body
+        count = len(body.chunks)
+        body.chunks = drop_superseded(body.chunks)
+        self.logger.info('Dropped %d superseded presence stanzas',
+                         count - len(body.chunks))
 
     send_element = send
 
@@ -356,9 +658,10 @@ class BOSHStream(Stream):
         if self.current_body:
             self.send_body()
         # try to enforce hold limit
-        while (len(self.consumers) > self.bosh_hold and
+        hold = self.get_hold()
+        while (len(self.consumers) > hold and
                self.rid_out in self.consumers):
-            self.current_body = BOSHBody()
+            self.current_body = PendingBody()
             self.send_body()
 
     def _auth_success(self, jid):
@@ -368,8 +671,9 @@ class BOSHStream(Stream):
             self.restarting = False
 
     def terminate(self, condition=None, data=None):
+        self.terminated = True
         if not self.current_body:
-            self.current_body = BOSHBody()
+            self.current_body = PendingBody()
         self.current_body['type'] = 'terminate'
         if condition:
             self.current_body['condition'] = condition
@@ -377,13 +681,11 @@ class BOSHStream(Stream):
             self.current_body.append(data)
         if not self.consumers:
             return
-        consumer = self.consumers.pop(self.rid_out, None)
+        consumer = self.consumers.remove(self.rid_out)
         if not consumer:
             # if we've lost rid_out, just pick
-            # some arbitrary consumer for now,
-            # though perhaps we're supposed to
-            # pick oldest or something
-            rid, consumer = self.consumers.popitem()
+            # the oldest consumer
+            rid, consumer = self.consumers.pop_oldest()
         self.send_body_to(consumer)
         self.flush_requests()
         self.connection_lost()
@@ -395,7 +697,7 @@ class BOSHStream(Stream):
     async def send_init(self, xml=None):
         # finish initialization of non-prebound sessions
         if self.sid is None:
-            self.sid = await self.generate_id()
+            self.sid = await self.generate_sid()
             self.update_logger({'sid': self.sid})
             if not self.consumers:
                 # nobody to send the sid to
@@ -410,16 +712,18 @@ class BOSHStream(Stream):
                                           trust=self.trust_origin)
         self.send_freeze()
         if not self.current_body:
-            body = BOSHBody()
-            attrs = body.xml.attrib
+            body = PendingBody()
+            attrs = body.attrs
+            attrs['xmlns:xmpp'] = NS_XBOSH
             attrs['from'] = self.host
             attrs['sid'] = self.sid
-            attrs[xbosh_restartlogic] = 'true'
-            attrs[xbosh_version] = self.version
+            attrs['xmpp:restartlogic'] = 'true'
+            attrs['xmpp:version'] = self.version
             attrs['ver'] = self.bosh_ver
             attrs['wait'] = str(self.bosh_wait)
             attrs['hold'] = str(self.bosh_hold)
             attrs['requests'] = str(self.bosh_requests)
+            attrs['polling'] = str(settings.BOSH_POLLING)
             attrs['inactivity'] = str(self.bosh_inactivity)
             attrs['ack'] = str(self.rid_in - 1)
             self.current_body = body
@@ -441,8 +745,20 @@ async def prebind_bosh_stream(web_user, username, domain, resource=None,
     stream.web_user = web_user
     return await stream.prebind(username, domain, resource)
 
-async def handle_bosh(consumer, xml):
+async def send_terminate(consumer, condition):
+    reply = BOSHBody()
+    reply['type'] = 'terminate'
+    reply['condition'] = condition
+    await consumer.send_data(tostring(reply.xml, top_level=True),
+                             build_headers(origin=consumer.http_origin,
+                                           trust=consumer.is_trusted()))
+
+async def handle_bosh(consumer, xml, size=0):
     if 'sid' not in xml.attrib:
+        if not admit_connection(consumer.client_host):
+            consumer.logger.warning('Connection rate exceeded, refusing session')
+            await send_terminate(consumer, 'policy-violation')
+            return
         stream = BOSHStream()
         stream.http_host = consumer.http_host
         stream.http_origin = consumer.http_origin
@@ -450,15 +766,21 @@ async def handle_bosh(consumer, xml):
         if stream.trust_origin:
             stream.web_user = await consumer.get_user()
     else:
-        stream = get_local_stream(xml.attrib['sid'])
+        sid = xml.attrib['sid']
+        stream = get_local_stream(sid)
         if not stream:
+            channel = None
+            if settings.BOSH_CLUSTER_ROUTING:
+                channel = get_owner_channel(sid)
+            if channel and not isinstance(consumer, RemoteConsumer):
+                # session belongs to another process; forward in the
+                # background, so we can still notice if the client
+                # goes away before the answer comes back
+                consumer.forward_task = consumer.loop.create_task(
+                    forward_bosh(consumer, channel, xml))
+                return
             # stream is gone
-            reply = BOSHBody()
-            reply['type'] = 'terminate'
-            reply['condition'] = 'remote-connection-failed'
-            await consumer.send_data(tostring(reply.xml, top_level=True),
-                                     build_headers(origin=consumer.http_origin,
-                                                   trust=consumer.is_trusted()))
+            await send_terminate(consumer, 'remote-connection-failed')
             return
         if stream.http_host != consumer.http_host:
             # We're going to consider an unexpected host fishy,
@@ -475,9 +797,120 @@ async def handle_bosh(consumer, xml):
             # the browser what origin we accept, it'll do the rest.
             await consumer.send_response(stream.http_headers)
             return
+        stream.shaper.count_bytes(size)
+        delay = stream.shaper.delay()
+        if delay:
+            # client is over its budget, hold its request for a while
+            await asyncio.sleep(delay)
     consumer.stream = stream
     stream.add_consumer_threadsafe(consumer, xml)
 
 async def disconnect_bosh(consumer):
     if consumer.stream:
         consumer.stream.remove_consumer_threadsafe(consumer)
+    elif consumer.forward_task:
+        consumer.forward_task.cancel()
+        consumer.forward_task = None
+        channel, request_id = consumer.forwarded
+        await node.send(channel, {
+            'type': 'bosh.disconnect',
+            'reply_to': node_channel,
+            'request_id': request_id,
+        })
+
+# Cluster routing: requests for sessions owned by other processes
+# are forwarded to them over the channel layer.
+
+async def forward_bosh(consumer, channel, xml):
+    msg = {
+        'type': 'bosh.request',
+        'request_id': node.new_request_id(),
+        # the raw request body isn't kept around
+        'body': tostring(xml, top_level=True).encode('utf8'),
+        'host': consumer.http_host,
+        'origin': consumer.http_origin,
+        'trusted': consumer.is_trusted(),
+        'client': consumer.logger.extra['client'],
+    }
+    consumer.forwarded = (channel, msg['request_id'])
+    # the owner acknowledges the request right away, and answers
+    # within the BOSH wait time, unless it's gone, or too busy
+    # to matter
+    timeout = settings.BOSH_MAX_WAIT + 10
+    try:
+        reply = await node.request(channel, msg, timeout,
+                                   settings.BOSH_CLUSTER_ACK_TIMEOUT)
+    except (asyncio.TimeoutError, ChannelFull):
+        consumer.logger.warning('No answer from %s, terminating session',
+                                channel)
+        consumer.forward_task = None
+        await send_terminate(consumer, 'remote-connection-failed')
+        return
+    consumer.forward_task = None
+    if reply['status'] == 200:
+        # compressed here, since only we know what the client accepts
+        await consumer.send_data(reply['body'], reply['headers'])
+        return
+    await consumer.send_response(reply['headers'],
+                                 reply['body'],
+                                 reply['status'])
+
+class RemoteConsumer(object):
+    # Stands in for a BOSH consumer in another process,
+    # which forwarded a request for one of our sessions.
+    def __init__(self, msg):
+        self.request = msg
+        self.logger = logging.LoggerAdapter(
+            logging.getLogger('xmppserver.transport.bosh'),
+            {'client': msg['client']})
+        self.stream = None
+        self.rid = None
+        self.answered = False
+        self.forward_task = None
+        self.http_host = msg['host']
+        self.http_origin = msg['origin']
+        self.trusted = msg['trusted']
+        self.loop = asyncio.get_event_loop()
+
+    def is_trusted(self):
+        return self.trusted
+
+    async def get_user(self):
+        return None
+
+    async def send_response(self, headers=[], body=b'', status=200):
+        remote_consumers.pop(self.key, None)
+        await node.reply(self.request, {
+            'status': status,
+            'headers': headers,
+            'body': body,
+        })
+
+    async def send_data(self, data, headers):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        self.logger.debug('Send sid="%s" rid="%s": %s',
+                          self.stream and self.stream.sid, self.rid,
+                          data)
+        await self.send_response(headers, data)
+
+    @property
+    def key(self):
+        return (self.request['reply_to'], self.request['request_id'])
+
+# forwarded requests that haven't been answered yet
+remote_consumers = {}
+
+async def remote_request(msg):
+    consumer = RemoteConsumer(msg)
+    remote_consumers[consumer.key] = consumer
+    xml = parse_xml(msg['body'])
+    await handle_bosh(consumer, xml, len(msg['body']))
+
+async def remote_disconnect(msg):
+    consumer = remote_consumers.pop((msg['reply_to'], msg['request_id']), None)
+    if consumer is not None:
+        await disconnect_bosh(consumer)
+
+node.register_handler('bosh.request', remote_request)
+node.register_handler('bosh.disconnect', remote_disconnect)
@@ -0,0 +1,91 @@
+from slixmpp.plugins.xep_0352 import stanza as csi_stanza
+from slixmpp.stanza import StreamFeatures
+from slixmpp.xmlstream.matcher import MatchXPath
+from slixmpp.xmlstream.stanzabase import register_stanza_plugin
+from collections import OrderedDict
+from .matcher import register_handlers
+from .outbound import presence_key
+
+# Client State Indication (XEP-0352)
+
+NS_CSI = 'urn:xmpp:csi:0'
+NS_CHATSTATES = 'http://jabber.org/protocol/chatstates'
+
+register_stanza_plugin(StreamFeatures, csi_stanza.ClientStateIndication)
+
+def is_chat_state(xml):
+    # a message that carries nothing but a chat state
+    # notification (XEP-0085), e.g. "composing", and maybe
+    # its thread; receipts, markers, corrections, encrypted
+    # payloads and so on must still be delivered
+    chat_state = False
+    for child in xml:
+        if child.tag.startswith('{%s}' % NS_CHATSTATES):
+            chat_state = True
+        elif child.tag != '{jabber:client}thread':
+            return False
+    return chat_state
+
+class ClientState(object):
+    handlers = (
+        # StanzaPath('active') would also match <inactive/>,
+        # since slixmpp checks plugin_attrib as a substring
+        ('CSI Active', MatchXPath('{%s}active' % NS_CSI), '_handle_active'),
+        ('CSI Inactive', MatchXPath('{%s}inactive' % NS_CSI),
+         '_handle_inactive'),
+    )
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.active = True
+        # presence held back while the client is inactive,
+        # only the latest one from each sender is kept
+        self.held_presence = OrderedDict()
+
+        stream.register_feature('csi', None)
+        stream.register_stanza(csi_stanza.Active)
+        stream.register_stanza(csi_stanza.Inactive)
+        register_handlers(stream, self, self.handlers)
+
+    def hold_presence(self, xml):
+        # Returns True if the presence stanza should not be sent yet.
+        if self.active:
+            return False
+        key = presence_key(xml)
+        if key is None:
+            # subscription requests and such are sent right away
+            return False
+        self.held_presence.pop(key, None)
+        self.held_presence[key] = xml
+        return True
+
+    def filter_message(self, xml):
+        # Returns False if the message should be dropped. Otherwise,
+        # any held presence is sent first, since the client is going
+        # to wake up for this message anyway.
+        if self.active:
+            return True
+        if is_chat_state(xml):
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        held = self.held_presence
+        if not held:
+            return
+        self.held_presence = OrderedDict()
+        self.stream.logger.debug('Sending %d held presence stanzas', len(held))
+        for xml in held.values():
+            self.stream.send_element(xml)
+
+    def _handle_active(self, element):
+        if not self.active:
+            self.stream.logger.debug('Client is active')
+            self.active = True
+            self.flush()
+
+    def _handle_inactive(self, element):
+        if self.active:
+            self.stream.logger.debug('Client is inactive')
+            self.active = False
@@ -1,9 +1,19 @@
-from slixmpp import Callback, JID, stanza
+from slixmpp import JID, stanza
 from slixmpp.plugins.xep_0030 import stanza as disco_stanza
 from slixmpp.xmlstream import register_stanza_plugin
-from .matcher import LocalStanzaPath
+from .matcher import LocalStanzaPath, register_handlers
+
+register_stanza_plugin(stanza.Iq, disco_stanza.DiscoInfo)
+register_stanza_plugin(stanza.Iq, disco_stanza.DiscoItems)
 
 class Disco(object):
+    handlers = (
+        ('Disco Info', LocalStanzaPath('iq/disco_info'),
+         '_handle_disco_info'),
+        ('Disco Items', LocalStanzaPath('iq/disco_items'),
+         '_handle_disco_items'),
+    )
+
     def __init__(self, stream):
         self.stream = stream
         self.disco_features = []
@@ -13,23 +23,14 @@ class Disco(object):
         stream.plugin._enabled.add('xep_0030')
         stream.plugin._plugins['xep_0030'] = self
 
-        register_stanza_plugin(stanza.Iq, disco_stanza.DiscoInfo)
-        register_stanza_plugin(stanza.Iq, disco_stanza.DiscoItems)
-
-        stream.register_handler(
-            Callback('Disco Info',
-                     LocalStanzaPath('iq/disco_info'),
-                     self._handle_disco_info))
-        stream.register_handler(
-            Callback('Disco Items',
-                     LocalStanzaPath('iq/disco_items'),
-                     self._handle_disco_items))
+        register_handlers(stream, self, self.handlers)
 
     def _end(self):
         pass
 
     def add_feature(self, feature):
-        self.disco_features.append(feature)
+        if feature not in self.disco_features:
+            self.disco_features.append(feature)
 
     def del_feature(self, feature):
         self.disco_features.remove(feature)
@@ -8,7 +8,7 @@ class DummyStream(Stream):
         super(DummyStream, self).__init__()
         self.prepare_features()
 
-    def send_element(self, xml):
+    def send_element(self, xml, text=None):
         pass
 
     def send_raw(self, data):
@@ -1,37 +1,223 @@
 from slixmpp import StanzaPath
 
-def is_server_stanza(stanza):
+# Where a stanza is addressed: the server itself, the bare JID of a local
+# user (which the server answers for), or somewhere else (a full JID, or
+# another domain). Most handlers' matchers check this, so it's worked out
+# once per stanza, and remembered on the stanza object.
+TARGET_SERVER = 'server'
+TARGET_USER = 'user'
+TARGET_REMOTE = 'remote'
+
+def get_stanza_target(stanza):
+    try:
+        return stanza.target_kind
+    except AttributeError:
+        pass
     target = stanza['to']
-    if target.user != '':
-        return False
     if target.domain != '' and \
        target.domain != stanza.stream.host:
-        return False
-    return True
+        kind = TARGET_REMOTE
+    elif target.user == '':
+        kind = TARGET_SERVER
+    elif target.resource == '':
+        kind = TARGET_USER
+    else:
+        kind = TARGET_REMOTE
+    stanza.target_kind = kind
+    return kind
+
+def is_server_stanza(stanza):
+    return get_stanza_target(stanza) == TARGET_SERVER
 
 def is_local_stanza(stanza):
-    target = stanza['to']
-    if target.user != '' and target.resource != '':
-        return False
-    if target.domain != '' and \
-       target.domain != stanza.stream.host:
-        return False
-    return True
+    return get_stanza_target(stanza) != TARGET_REMOTE
 
 class ServerStanzaPath(StanzaPath):
     def match(self, stanza):
         if not StanzaPath.match(self, stanza):
             return False
+        return self.match_target(stanza)
+
+    def match_target(self, stanza):
         return is_server_stanza(stanza)
 
 class LocalStanzaPath(StanzaPath):
     def match(self, stanza):
         if not StanzaPath.match(self, stanza):
             return False
+        return self.match_target(stanza)
+
+    def match_target(self, stanza):
         return is_local_stanza(stanza)
 
 class RemoteStanzaPath(StanzaPath):
     def match(self, stanza):
         if not StanzaPath.match(self, stanza):
             return False
+        return self.match_target(stanza)
+
+    def match_target(self, stanza):
         return not is_local_stanza(stanza)
+
+class TableHandler(object):
+    # An entry in a component's handler table. Unlike slixmpp's Callback,
+    # it isn't bound to a stream, so the same one serves every stream: the
+    # stream's HandlerIndex pairs it with the component, and the method is
+    # looked up on the component when a stanza is dispatched to it.
+    def __init__(self, name, matcher, method):
+        self.name = name
+        self._matcher = matcher
+        self.method = method
+
+    def match(self, stanza):
+        return self._matcher.match(stanza)
+
+# handler tables, and the TableHandlers made from them
+table_handlers = {}
+
+def register_handlers(stream, component, handlers):
+    # Handler tables are tuples of (name, matcher, method name), built
+    # once at import time. The handlers are made from them the first
+    # time they're registered, and shared by all streams after that.
+    table = table_handlers.get(handlers)
+    if table is None:
+        table = [TableHandler(name, matcher, method)
+                 for name, matcher, method in handlers]
+        table_handlers[handlers] = table
+    for handler in table:
+        stream.handler_index.add(handler, component)
+
+indexed_matchers = (StanzaPath, ServerStanzaPath, LocalStanzaPath,
+                    RemoteStanzaPath)
+
+def parse_stanza_path(matcher):
+    # Splits a simple stanza path, like 'iq@type=get/ping', into the name
+    # of the root stanza, the type it requires, the plugin it requires,
+    # and whether that's all there is to it. Returns None for paths
+    # (and matchers) that are too fancy to index.
+    if type(matcher) not in indexed_matchers:
+        return None
+    path = matcher._raw_criteria.strip('/')
+    if '{' in path:
+        return None
+    parts = path.split('/')
+    if len(parts) > 2:
+        return None
+    name, *attrs = parts[0].split('@')
+    stanza_type = None
+    exact = True
+    for attr in attrs:
+        key, sep, value = attr.partition('=')
+        if key == 'type' and stanza_type is None:
+            stanza_type = value
+        else:
+            exact = False
+    child = None
+    if len(parts) > 1:
+        child, *attrs = parts[1].split('@')
+        if attrs:
+            exact = False
+    return name, stanza_type, child, exact
+
+class HandlerIndex(object):
+    # Finds the handlers for a received stanza, without asking every
+    # registered handler's matcher in turn, which is what slixmpp does.
+    # Handlers whose matcher is a simple stanza path are filed under the
+    # tag of the root stanza the path selects, along with the type
+    # attribute and child element it requires, if any, so that a stanza
+    # is only checked against the handlers filed under its tag, and for
+    # most of those, comparing the type and child element decides it,
+    # without building any plugins. Other handlers are checked against
+    # every stanza, as before. Either way, handlers are returned in the
+    # order they were registered, as (handler, component) pairs, where
+    # the component is the one a TableHandler was registered for, and
+    # None for other handlers. The table is rebuilt whenever handlers
+    # or root stanza classes change.
+    def __init__(self, stream):
+        self.stream = stream
+        self.handlers = []
+        self.table = None
+
+    def add(self, handler, component=None):
+        self.handlers.append((handler, component))
+        self.table = None
+
+    def remove(self, name):
+        for handler, component in self.handlers:
+            if handler.name == name:
+                self.discard(handler, component)
+                return True
+        return False
+
+    def discard(self, handler, component=None):
+        self.handlers.remove((handler, component))
+        self.table = None
+
+    def invalidate(self):
+        self.table = None
+
+    def build(self):
+        stanza_tags = self.stream.get_stanza_tags()
+        table = {None: []}
+        for tag in stanza_tags:
+            table[tag] = []
+        for handler, component in self.handlers:
+            key = parse_stanza_path(handler._matcher)
+            tags = []
+            if key is not None:
+                name, stanza_type, child, exact = key
+                tags = [tag for tag, cls in stanza_tags.items()
+                        if cls.name == name]
+            if not tags:
+                # could be anything, try it on everything
+                for entries in table.values():
+                    entries.append((None, None, handler.match,
+                                    handler, component))
+                continue
+            match_target = getattr(handler._matcher, 'match_target', None)
+            for tag in tags:
+                cls = stanza_tags[tag]
+                entry_type = stanza_type
+                entry_exact = exact
+                if stanza_type is not None and hasattr(cls, 'get_type'):
+                    # the type interface isn't just the attribute
+                    entry_type = None
+                    entry_exact = False
+                child_tag = None
+                if child is not None:
+                    plugin = cls.plugin_attrib_map.get(child)
+                    if plugin is not None:
+                        child_tag = plugin.tag_name()
+                    else:
+                        entry_exact = False
+                if entry_exact:
+                    check = match_target
+                else:
+                    check = handler.match
+                table[tag].append((entry_type, child_tag, check,
+                                   handler, component))
+        self.table = table
+        return table
+
+    def lookup(self, stanza):
+        table = self.table
+        if table is None:
+            table = self.build()
+        xml = stanza.xml
+        entries = table.get(xml.tag)
+        if entries is None:
+            entries = table[None]
+        stanza_type = xml.get('type')
+        children = None
+        handlers = []
+        for entry_type, child_tag, check, handler, component in entries:
+            if entry_type is not None and entry_type != stanza_type:
+                continue
+            if child_tag is not None:
+                if children is None:
+                    children = set(child.tag for child in xml)
+                if child_tag not in children:
+                    continue
+            if check is None or check(stanza):
+                handlers.append((handler, component))
+        return handlers
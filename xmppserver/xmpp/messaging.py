@@ -1,6 +1,37 @@
-from slixmpp import Callback, StanzaPath, JID, stanza
+from slixmpp import StanzaPath, JID, stanza
+from slixmpp.plugins.xep_0203 import stanza as delay_stanza
+from slixmpp.plugins.xep_0280 import stanza as carbons_stanza
+from slixmpp.plugins.xep_0297 import stanza as forward_stanza
+from slixmpp.xmlstream import register_stanza_plugin
+from .matcher import register_handlers
+
+# Message Carbons (XEP-0280), and the Stanza Forwarding (XEP-0297)
+# and Delayed Delivery (XEP-0203) they build on. We only need slixmpp's
+# stanza classes for these, not its (client-side) plugins.
+register_stanza_plugin(stanza.Message, delay_stanza.Delay)
+register_stanza_plugin(stanza.Presence, delay_stanza.Delay)
+register_stanza_plugin(stanza.Message, forward_stanza.Forwarded)
+register_stanza_plugin(forward_stanza.Forwarded, stanza.Message, iterable=True)
+register_stanza_plugin(forward_stanza.Forwarded, stanza.Presence, iterable=True)
+register_stanza_plugin(forward_stanza.Forwarded, stanza.Iq, iterable=True)
+register_stanza_plugin(forward_stanza.Forwarded, delay_stanza.Delay)
+register_stanza_plugin(stanza.Message, carbons_stanza.ReceivedCarbon)
+register_stanza_plugin(stanza.Message, carbons_stanza.SentCarbon)
+register_stanza_plugin(stanza.Message, carbons_stanza.PrivateCarbon)
+register_stanza_plugin(stanza.Iq, carbons_stanza.CarbonEnable)
+register_stanza_plugin(stanza.Iq, carbons_stanza.CarbonDisable)
+register_stanza_plugin(carbons_stanza.ReceivedCarbon, forward_stanza.Forwarded)
+register_stanza_plugin(carbons_stanza.SentCarbon, forward_stanza.Forwarded)
 
 class Messaging(object):
+    handlers = (
+        ('Messaging', StanzaPath('message'), '_handle_message'),
+        ('Carbon Enable', StanzaPath('iq/carbon_enable'),
+         '_handle_carbon_enable'),
+        ('Carbon Disable', StanzaPath('iq/carbon_disable'),
+         '_handle_carbon_disable'),
+    )
+
     def __init__(self, stream):
         self.stream = stream
         self.recv_task = None
@@ -8,20 +39,9 @@ class Messaging(object):
         self.carbon_enabled = False
 
         stream.register_stanza(stanza.Message)
-        stream.register_handler(
-            Callback('Messaging',
-                     StanzaPath('message'),
-                     self._handle_message))
-
-        stream.register_plugin('xep_0280')
-        stream.register_handler(
-            Callback('Carbon Enable',
-                     StanzaPath('iq/carbon_enable'),
-                     self._handle_carbon_enable))
-        stream.register_handler(
-            Callback('Carbon Disable',
-                     StanzaPath('iq/carbon_disable'),
-                     self._handle_carbon_disable))
+        register_handlers(stream, self, self.handlers)
+        stream.disco.add_feature(forward_stanza.Forwarded.namespace)
+        stream.disco.add_feature(carbons_stanza.ReceivedCarbon.namespace)
 
     def _handle_message(self, msg):
         msg['from'] = self.stream.boundjid
@@ -50,9 +70,11 @@ class Messaging(object):
             # not meant for this stream
             if self.carbon_enabled and not private:
                 # but if carbons are enabled...
-                self.carbon_wrap(xml, 'carbon_received').send()
+                if self.stream.csi.filter_message(xml):
+                    self.carbon_wrap(xml, 'carbon_received').send()
             return
-        self.stream.send_element(xml)
+        if self.stream.csi.filter_message(xml):
+            self.stream.send_element(xml, self.stream.ipc_text)
 
     async def ipc_recv_message(self, origin, ifrom, xml):
         self.relay(origin, ifrom, xml)
@@ -64,7 +86,8 @@ class Messaging(object):
         if self.carbon_enabled:
             if ifrom == self.stream.boundjid.full:
                 return
-            self.carbon_wrap(xml, 'carbon_sent').send()
+            if self.stream.csi.filter_message(xml):
+                self.carbon_wrap(xml, 'carbon_sent').send()
         return
 
     async def _ipc_send_message(self, msg):
@@ -91,11 +114,13 @@ class Messaging(object):
             del msg['carbon_private']
             await self.stream.ipc_send('messaging.private',
                                        target,
-                                       msg.xml)
+                                       msg.xml,
+                                       serialize=True)
         else:
             await self.stream.ipc_send('messaging.message',
                                        target,
-                                       msg.xml)
+                                       msg.xml,
+                                       serialize=True)
             await self.stream.ipc_send('messaging.carbon',
                                        self.stream.boundjid,
                                        msg.xml)
@@ -0,0 +1,27 @@
+# Helpers for outbound stanza queues
+
+def presence_key(xml):
+    # Presence updates and absences from the same sender supersede
+    # each other, so only the most recent one needs to be delivered.
+    # Subscription requests and such must never be dropped, though.
+    tag = xml.tag
+    if tag != 'presence' and not tag.endswith('}presence'):
+        return None
+    if xml.attrib.get('type', 'available') not in ('available',
+                                                    'unavailable'):
+        return None
+    return xml.attrib.get('from')
+
+def drop_superseded(entries):
+    # entries are (data, key) pairs, keep only the last one of each key
+    seen = set()
+    kept = []
+    for entry in reversed(entries):
+        key = entry[1]
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(entry)
+    kept.reverse()
+    return kept
@@ -1,6 +1,87 @@
+from slixmpp import StanzaPath
+from slixmpp.plugins.xep_0199 import stanza as ping_stanza
+from slixmpp.stanza import Iq
+from slixmpp.xmlstream import register_stanza_plugin
+from .matcher import register_handlers
+from ..conf import settings
+from ..timers import get_timer_wheel
+
+register_stanza_plugin(Iq, ping_stanza.Ping)
+
 class Ping(object):
+    # Server-initiated pings (XEP-0199), so that connections that died
+    # without closing (e.g. the client lost its network) are noticed
+    # long before the OS gives up on them. A bound stream that the client
+    # hasn't sent anything on for an interval is pinged, and if it's still
+    # silent after the timeout, it's dropped. Any traffic from the client
+    # counts, not just ping replies, so busy streams are never pinged.
+    # The timers live on the shared timer wheel.
+    handlers = (
+        ('Ping', StanzaPath('iq@type=get/ping'), '_handle_ping'),
+    )
+
     def __init__(self, stream):
+        self.stream = stream
+        self.timer = None
+        self.active = False
+        self.pinged = False
         stream.whitespace_keepalive = stream.whitespace_keepalives
-        stream.register_plugin('xep_0199')
-        # TODO: implement ping keepalives that work for servers
+        register_handlers(stream, self, self.handlers)
+        stream.disco.add_feature(ping_stanza.Ping.namespace)
+        if stream.ping_keepalives and settings.STREAM_PING_INTERVAL:
+            stream.add_event_handler('session_bind',
+                                     self._session_bind)
+            stream.add_event_handler('disconnected',
+                                     self._disconnected)
+
+    def received(self):
+        # called whenever the client sends something
+        self.active = True
+
+    def _handle_ping(self, iq):
+        iq.reply().send()
+
+    def _session_bind(self, jid):
+        self._schedule(settings.STREAM_PING_INTERVAL)
+
+    def _disconnected(self, reason=None):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _schedule(self, delay):
+        self.timer = get_timer_wheel(self.stream.loop).call_later(
+            delay, self._check)
+
+    def _check(self):
+        # Since activity is only checked once per interval, a silent
+        # client is pinged after one to two intervals.
+        self.timer = None
+        stream = self.stream
+        if self.active or (stream.sm and stream.sm.detached):
+            # nothing to worry about, or nothing to ping
+            # (the session is waiting for resumption)
+            self.active = False
+            self.pinged = False
+            self._schedule(settings.STREAM_PING_INTERVAL)
+        elif not self.pinged:
+            self.pinged = True
+            self._send_ping()
+            self._schedule(settings.STREAM_PING_TIMEOUT)
+        else:
+            stream.logger.info('No reply to ping, dropping connection')
+            self.pinged = False
+            # if the session ends, this is cancelled again, but it
+            # may also wait for resumption, and carry on after that
+            self._schedule(settings.STREAM_PING_INTERVAL)
+            stream.ping_timeout()
 
+    def _send_ping(self):
+        iq = Iq(self.stream)
+        iq['type'] = 'get'
+        iq['id'] = self.stream.new_id()
+        iq['from'] = self.stream.host
+        iq['to'] = self.stream.boundjid
+        iq.enable('ping')
+        # the reply (or error) is just traffic, there's no handler for it
+        self.stream.send(iq)
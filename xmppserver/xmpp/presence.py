@@ -1,7 +1,8 @@
-from slixmpp import Callback, StanzaPath, JID, stanza
+from slixmpp import StanzaPath, JID, stanza
 from slixmpp.exceptions import XMPPError
 from slixmpp.xmlstream import tostring
 from xml.etree import ElementTree as ET
+from .matcher import register_handlers
 
 def build_presence_xml(jid, type='available'):
     msg = stanza.Presence()
@@ -20,6 +21,9 @@ class Presence(object):
     from_types = {'from', 'both'}
     unsubscribe_map = {'both': 'from', 'to': 'none'}
     unsubscribed_map = {'both': 'to', 'from': 'none'}
+    handlers = (
+        ('Presence', StanzaPath('presence'), '_handle_presence'),
+    )
 
     def __init__(self, stream):
         self.stream = stream
@@ -28,10 +32,7 @@ class Presence(object):
         self.directed_presence = set()
 
         stream.register_stanza(stanza.Presence)
-        stream.register_handler(
-            Callback('Presence',
-                     StanzaPath('presence'),
-                     self._handle_presence))
+        register_handlers(stream, self, self.handlers)
 
         stream.add_event_handler('disconnected',
                                  self._disconnected)
@@ -84,6 +85,8 @@ class Presence(object):
         if not self.available:
             return
         xml.attrib['to'] = self.stream.boundjid.bare
+        if self.stream.csi.hold_presence(xml):
+            return
         self.stream.send_element(xml)
 
     async def ipc_recv_available(self, origin, ifrom, xml):
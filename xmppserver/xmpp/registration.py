@@ -1,20 +1,38 @@
-from slixmpp import Callback
 from slixmpp.exceptions import XMPPError
+from slixmpp.plugins.xep_0004 import stanza as form_stanza
+from slixmpp.plugins.xep_0066 import stanza as oob_stanza
 from slixmpp.plugins.xep_0077 import stanza as register_stanza
-from .matcher import ServerStanzaPath
+from slixmpp.stanza import Iq, StreamFeatures
+from slixmpp.xmlstream import register_stanza_plugin
+from .matcher import ServerStanzaPath, register_handlers
 from ..conf import settings
 
+# In-Band Registration (XEP-0077), with Data Forms (XEP-0004) and
+# Out of Band Data (XEP-0066), which the registration form may use.
+register_stanza_plugin(StreamFeatures, register_stanza.RegisterFeature)
+register_stanza_plugin(Iq, register_stanza.Register)
+register_stanza_plugin(form_stanza.FormField, form_stanza.FieldOption,
+                       iterable=True)
+register_stanza_plugin(form_stanza.Form, form_stanza.FormField,
+                       iterable=True)
+register_stanza_plugin(register_stanza.Register, form_stanza.Form)
+register_stanza_plugin(register_stanza.Register, oob_stanza.OOB)
+
 class Registration(object):
+    handlers = (
+        ('Registration', ServerStanzaPath('iq/register'),
+         '_handle_register'),
+    )
+
     def __init__(self, stream):
         self.stream = stream
 
-        stream.register_plugin('xep_0077')
-        stream['xep_0030'].add_feature(register_stanza.Register.namespace)
+        disco = stream['xep_0030']
+        disco.add_feature(register_stanza.Register.namespace)
+        disco.add_feature(form_stanza.Form.namespace)
+        disco.add_feature(oob_stanza.OOB.namespace)
 
-        stream.register_handler(
-            Callback('Registration',
-                     ServerStanzaPath('iq/register'),
-                     self._handle_register))
+        register_handlers(stream, self, self.handlers)
 
     def _handle_register(self, iq):
         type = iq['type']
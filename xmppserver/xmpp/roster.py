@@ -1,12 +1,18 @@
-from slixmpp import Callback, JID
+from slixmpp import JID
 from slixmpp.exceptions import XMPPError
-from slixmpp.stanza import Iq, roster as roster_stanza
+from slixmpp.features.feature_preapproval import stanza as preapproval_stanza
+from slixmpp.stanza import Iq, StreamFeatures, roster as roster_stanza
 from slixmpp.xmlstream import register_stanza_plugin
-from .matcher import ServerStanzaPath
+from .matcher import ServerStanzaPath, register_handlers
 
 register_stanza_plugin(Iq, roster_stanza.Roster)
+register_stanza_plugin(StreamFeatures, preapproval_stanza.PreApproval)
 
 class Roster(object):
+    handlers = (
+        ('Roster', ServerStanzaPath('iq/roster'), '_handle_roster'),
+    )
+
     def __init__(self, stream):
         self.stream = stream
         self.interested = False
@@ -14,12 +20,9 @@ class Roster(object):
         self.delay_pushes = 0
         self.delayed_pushes = []
 
-        stream.register_plugin('feature_preapproval')
+        stream.register_feature('preapproval', None)
         # TBD: should we try to support roster versioning?
-        stream.register_handler(
-            Callback('Roster',
-                     ServerStanzaPath('iq/roster'),
-                     self._handle_roster))
+        register_handlers(stream, self, self.handlers)
 
     def _handle_roster(self, iq):
         iq['from'] = self.stream.boundjid
@@ -0,0 +1,229 @@
+from slixmpp import StanzaPath
+from slixmpp.plugins.xep_0198 import stanza as sm_stanza
+from slixmpp.stanza import StreamError, StreamFeatures
+from slixmpp.xmlstream.matcher import MatchXPath
+from slixmpp.xmlstream.stanzabase import ET, register_stanza_plugin
+from .matcher import register_handlers
+from ..conf import settings
+from collections import deque
+import uuid
+
+# Stream Management (XEP-0198)
+
+NS_SM = 'urn:xmpp:sm:3'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+STANZA_TAGS = {'{jabber:client}message',
+               '{jabber:client}presence',
+               '{jabber:client}iq'}
+
+# ask the client for an ack once this many stanzas are unacknowledged
+ACK_REQUEST_THRESHOLD = 5
+
+register_stanza_plugin(StreamFeatures, sm_stanza.StreamManagement)
+
+# Resumable sessions handled by this process, by stream management id.
+# (Resumption only works if the client reconnects to the same process.)
+sessions = {}
+
+def count_add(a, b):
+    # the h counters wrap around at 2^32
+    return (a + b) % (1 << 32)
+
+def build_failed(condition):
+    failed = sm_stanza.Failed()
+    failed.xml.append(ET.Element('{%s}%s' % (NS_STANZAS, condition)))
+    return failed
+
+class StreamManagement(object):
+    handlers = (
+        ('SM Enable', StanzaPath('enable'), '_handle_enable'),
+        ('SM Resume', StanzaPath('resume'), '_handle_resume'),
+        # StanzaPath('a') would match every stanza whose plugin_attrib
+        # contains an 'a' (message, presence), since slixmpp checks it
+        # as a substring, so match the tags exactly
+        ('SM Request', MatchXPath('{%s}r' % NS_SM), '_handle_request'),
+        ('SM Ack', MatchXPath('{%s}a' % NS_SM), '_handle_ack'),
+    )
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.enabled = False
+        self.resumable = False
+        self.detached = False
+        self.id = None
+        self.handled = 0      # stanzas received from the client
+        self.acked = 0        # stanzas acknowledged by the client
+        self.unacked = deque()
+        self.ack_requested = False
+        self.timeout_handle = None
+
+        stream.register_feature('sm', None)
+        stream.register_stanza(sm_stanza.Enable)
+        stream.register_stanza(sm_stanza.Resume)
+        stream.register_stanza(sm_stanza.RequestAck)
+        stream.register_stanza(sm_stanza.Ack)
+        register_handlers(stream, self, self.handlers)
+
+    # called by the stream for every element received or sent
+
+    def received(self, xml):
+        if self.enabled and xml.tag in STANZA_TAGS:
+            self.handled = count_add(self.handled, 1)
+
+    def sent(self, xml, data):
+        if not self.enabled or xml.tag not in STANZA_TAGS:
+            return
+        self.unacked.append(data)
+        if len(self.unacked) > settings.STREAM_QUEUE_LIMIT:
+            # the client doesn't seem to be acknowledging anything
+            self.stream.check_queue()
+        elif not self.ack_requested and not self.detached and \
+             len(self.unacked) >= ACK_REQUEST_THRESHOLD:
+            self.ack_requested = True
+            self.stream.send(sm_stanza.RequestAck())
+
+    def get_queue_depth(self):
+        return len(self.unacked)
+
+    # connection handling
+
+    def detach(self):
+        # Called when the connection is lost. If the session can be
+        # resumed, keep it around for a while and return True.
+        if not self.resumable or self.stream.kicked:
+            self.discard()
+            return False
+        self.stream.logger.info('Connection lost, waiting %d seconds for resumption',
+                                settings.STREAM_RESUME_TIMEOUT)
+        self.detached = True
+        self.ack_requested = False
+        self.timeout_handle = self.stream.loop.call_later(
+            settings.STREAM_RESUME_TIMEOUT,
+            self._resume_timeout)
+        return True
+
+    def terminate(self):
+        # The stream is being closed on purpose, so the session
+        # must not be resumed. If it's already detached, end it now.
+        self.resumable = False
+        if self.detached:
+            self.detached = False
+            self.discard()
+            self.stream.end_session()
+
+    def discard(self):
+        if self.timeout_handle:
+            self.timeout_handle.cancel()
+            self.timeout_handle = None
+        if self.id is not None and sessions.get(self.id) is self.stream:
+            del sessions[self.id]
+
+    def _resume_timeout(self):
+        self.timeout_handle = None
+        self.stream.logger.info('Session not resumed in time')
+        self.terminate()
+
+    def _acknowledge(self, h):
+        count = (h - self.acked) % (1 << 32)
+        if count > len(self.unacked):
+            self.stream.logger.warning('Client acknowledged %d stanzas, but only %d were sent',
+                                       count, len(self.unacked))
+            count = len(self.unacked)
+        for i in range(count):
+            self.unacked.popleft()
+        self.acked = h
+        if self.stream.ipc_paused:
+            self.stream.check_queue()
+
+    def _count_too_high(self, h):
+        # XEP-0198 says to close the stream when the client
+        # acknowledges more stanzas than it was sent
+        sent = count_add(self.acked, len(self.unacked))
+        error = StreamError()
+        error['condition'] = 'undefined-condition'
+        error['text'] = ('You acknowledged %d stanzas, but only %d were sent' %
+                         (h, sent))
+        ET.SubElement(error.xml, '{%s}handled-count-too-high' % NS_SM,
+                      h=str(h), attrib={'send-count': str(sent)})
+        self.stream.send_error(error)
+
+    # stanza handlers
+
+    def _handle_enable(self, enable):
+        if not self.stream.session_bind_event.is_set() or self.enabled:
+            self.stream.send(build_failed('unexpected-request'))
+            return
+        self.enabled = True
+        reply = sm_stanza.Enabled()
+        if enable['resume'] and settings.STREAM_RESUME_TIMEOUT:
+            self.resumable = True
+            self.id = uuid.uuid4().hex
+            sessions[self.id] = self.stream
+            reply['id'] = self.id
+            reply['resume'] = True
+            reply['max'] = str(settings.STREAM_RESUME_TIMEOUT)
+        self.stream.logger.debug('Stream management enabled')
+        self.stream.send(reply)
+
+    def _handle_resume(self, resume):
+        stream = self.stream
+        old = sessions.get(resume['previd'])
+        if 'mechanisms' not in stream.features or \
+           stream.session_bind_event.is_set() or self.enabled:
+            self.stream.send(build_failed('unexpected-request'))
+            return
+        if old is None or old is stream or \
+           type(old) is not type(stream) or \
+           old.boundjid.bare != stream.boundjid.bare or \
+           old.kicked:
+            self.stream.logger.info('Session %s cannot be resumed',
+                                    resume['previd'])
+            self.stream.send(build_failed('item-not-found'))
+            return
+        old.sm.resume(stream, resume['h'] or 0)
+
+    def _handle_request(self, request):
+        if not self.enabled:
+            return
+        ack = sm_stanza.Ack()
+        ack['h'] = self.handled
+        self.stream.send(ack)
+
+    def _handle_ack(self, ack):
+        if not self.enabled:
+            return
+        self.ack_requested = False
+        h = ack['h'] or 0
+        if (h - self.acked) % (1 << 32) > len(self.unacked):
+            self._count_too_high(h)
+            return
+        self._acknowledge(h)
+
+    # resumption
+
+    def resume(self, other, h):
+        # Move the connection of the other (newly authenticated)
+        # stream over to this one, and continue where we left off.
+        stream = self.stream
+        if self.timeout_handle:
+            self.timeout_handle.cancel()
+            self.timeout_handle = None
+        if not self.detached:
+            # the client noticed that the old connection
+            # was dead before we did
+            stream.logger.info('Dropping old connection')
+            stream.drop_connection()
+        self.detached = False
+        stream.logger.info('Resuming session')
+        stream.take_connection(other)
+        other.retire(stream)
+        self._acknowledge(h)
+        reply = sm_stanza.Resumed()
+        reply['previd'] = self.id
+        reply['h'] = self.handled
+        stream.send(reply)
+        # whatever the client didn't get is sent again,
+        # and stays unacknowledged until the client says otherwise
+        for data in self.unacked:
+            stream.send_raw(data)
+        stream.check_queue()
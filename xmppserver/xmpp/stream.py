@@ -1,11 +1,12 @@
-from channels.layers import get_channel_layer
-from slixmpp import BaseXMPP, Callback, JID
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from slixmpp import BaseXMPP, JID
 from slixmpp.api import APIRegistry
 from slixmpp.plugins import PluginManager
-from slixmpp.stanza import Iq, StreamError
+from slixmpp.plugins.xep_0086.stanza import LegacyError
+from slixmpp.stanza import Error, Iq, StreamError
 from slixmpp.xmlstream import (ElementBase, StanzaBase, XMLStream,
-                               tostring)
-from .matcher import RemoteStanzaPath
+                               register_stanza_plugin, tostring)
+from .matcher import HandlerIndex, RemoteStanzaPath, register_handlers
 from .features import Features
 from .auth import Auth
 from .disco import Disco
@@ -14,11 +15,55 @@ from .roster import Roster
 from .presence import Presence
 from .messaging import Messaging
 from .registration import Registration
+from .sm import StreamManagement
+from .csi import ClientState
+from ..cluster import node_id
 from ..conf import settings
 from ..hooks import get_hook
-import asyncio, uuid
+from ..shaping import StreamShaper
+from copy import deepcopy
+import asyncio, ssl, uuid, weakref
 import logging
 
+# streams handled by this process, for monitoring
+live_streams = weakref.WeakSet()
+
+# Bound streams handled by this process, so that IPC messages between
+# them can be delivered directly instead of through the channel layer
+# (see Stream.ipc_send): by group (i.e. username), full JID, and channel.
+local_groups = {}
+local_jids = {}
+local_channels = {}
+
+# XMLStream wants an SSL context for outgoing connections, which we never
+# make, and creates one (loading the system's CA certificates) if not
+# given one, so just give every stream this one
+client_ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+
+# legacy error codes (XEP-0086)
+register_stanza_plugin(Error, LegacyError, overrides=True)
+
+stream_handlers = (
+    ('Remote Iq', RemoteStanzaPath('iq'), '_handle_iq'),
+)
+
+def get_queue_stats():
+    """
+    Get statistics about the outbound queues of the streams
+    handled by this process, e.g. for monitoring and alerting.
+
+    :return: Dictionary with the number of streams, the total and
+             largest number of queued stanzas, and the number of
+             streams whose inbox is paused
+    """
+    depths = [stream.get_queue_depth() for stream in live_streams]
+    return {
+        'streams': len(depths),
+        'queued': sum(depths),
+        'max_queued': max(depths, default=0),
+        'paused': sum(1 for stream in live_streams if stream.ipc_paused),
+    }
+
 def min_version(a, b):
     v_a = [int(x) for x in a.split('.')]
     v_b = [int(x) for x in b.split('.')]
@@ -35,11 +80,15 @@ class StreamElement(StanzaBase):
 class Stream(BaseXMPP):
     ping_keepalives = False
     whitespace_keepalives = False
+    stream_management = False
 
     def __init__(self):
         # BaseXMPP does way too much crap in its __init__,
         # we'll have to skip it and do stuff ourselves
-        XMLStream.__init__(self)
+        XMLStream.__init__(self, ssl_context=client_ssl_context)
+        self.stanza_classes = []
+        self.stanza_tags = None
+        self.handler_index = HandlerIndex(self)
         self.default_ns = 'jabber:client'
         self.stream_ns = 'http://etherx.jabber.org/streams'
         self.namespace_map[self.stream_ns] = 'stream'
@@ -77,25 +126,36 @@ class Stream(BaseXMPP):
         self.channel_name = None
         self.group_name = None
         self.channel_layer = get_channel_layer('xmppserver')
-
-        self.register_plugin('xep_0086') # legacy error codes
+        self.ipc_inbox = None
+        self.ipc_local_only = False
+        self.ipc_local_keys = None
+        self.ipc_paused = False
+        # the text of the IPC message being handled, see ipc_send
+        self.ipc_text = None
+        self.ipc_resume_event = asyncio.Event()
+        self.ipc_resume_event.set()
+        self.successor = None
+        self.shaper = StreamShaper()
 
         self.features = Features(self)
         self.disco = Disco(self)
         self.auth = Auth(self)
         self.registration = Registration(self)
         self.ping = Ping(self)
+        if self.stream_management:
+            self.sm = StreamManagement(self)
+        else:
+            self.sm = None
+        self.csi = ClientState(self)
         # we only need the following components
         # after the client has authenticated.
         self.roster = None
         self.presence = None
         self.messaging = None
 
-        self.register_handler(
-            Callback('Remote Iq',
-                     RemoteStanzaPath('iq'),
-                     self._handle_iq))
+        register_handlers(self, self, stream_handlers)
 
+        live_streams.add(self)
         self.logger.debug('Creating stream')
 
     @property
@@ -138,9 +198,7 @@ class Stream(BaseXMPP):
         self.messaging = Messaging(self)
 
     async def bind(self):
-        self.channel_name = await self.channel_layer.new_channel()
-        self.group_name = self.group_for_user(self.boundjid)
-        self.recv_task = self.loop.create_task(self._receive_task())
+        await self.ipc_bind()
         await self.roster_hook.bind(self)
 
     async def unbind(self):
@@ -154,6 +212,19 @@ class Stream(BaseXMPP):
         await self._cleanup_task()
 
     def connection_lost(self, reason=None):
+        if self.sm and self.sm.detach():
+            # keep the session around, the client may resume it
+            return
+        self.end_session(reason)
+
+    def ping_timeout(self):
+        # The client stopped answering pings. Close the connection
+        # without waiting for the OS to notice, and carry on as if
+        # it had been lost.
+        self.drop_connection()
+        self.connection_lost('Ping timeout')
+
+    def end_session(self, reason=None):
         self.event('disconnected', reason)
         if self.recv_task:
             self.recv_task.cancel()
@@ -181,6 +252,87 @@ class Stream(BaseXMPP):
     def handle_stanza(self, xml):
         self._spawn_event(xml)
 
+    # Received stanzas are dispatched through a table instead of the
+    # lists slixmpp searches, see HandlerIndex.
+
+    def register_stanza(self, stanza_class):
+        super(Stream, self).register_stanza(stanza_class)
+        self.stanza_classes.append(stanza_class)
+        self.stanza_tags = None
+        self.handler_index.invalidate()
+
+    def remove_stanza(self, stanza_class):
+        super(Stream, self).remove_stanza(stanza_class)
+        self.stanza_classes.remove(stanza_class)
+        self.stanza_tags = None
+        self.handler_index.invalidate()
+
+    def get_stanza_tags(self):
+        # maps element tags to root stanza classes
+        # (the first one registered wins, like in slixmpp)
+        tags = self.stanza_tags
+        if tags is None:
+            tags = {}
+            for stanza_class in self.stanza_classes:
+                tags.setdefault('{%s}%s' % (self.default_ns, stanza_class.name),
+                                stanza_class)
+                tags.setdefault(stanza_class.tag_name(), stanza_class)
+            self.stanza_tags = tags
+        return tags
+
+    def register_handler(self, handler, before=None, after=None):
+        if handler.stream is None:
+            self.handler_index.add(handler)
+            handler.stream = weakref.ref(self)
+
+    def remove_handler(self, name):
+        return self.handler_index.remove(name)
+
+    def _build_stanza(self, xml, default_ns=None):
+        if default_ns is not None and default_ns != self.default_ns:
+            return super(Stream, self)._build_stanza(xml, default_ns)
+        stanza_class = self.get_stanza_tags().get(xml.tag, StanzaBase)
+        stanza = stanza_class(self, xml, recv=True)
+        if stanza['lang'] is None and self.peer_default_lang:
+            stanza['lang'] = self.peer_default_lang
+        return stanza
+
+    def recv_stanza(self, stanza):
+        # we don't use slixmpp's incoming filters,
+        # so there's nothing to apply here
+        handled = False
+        for handler, component in self.handler_index.lookup(stanza):
+            if component is not None:
+                # a TableHandler, see register_handlers
+                try:
+                    getattr(component, handler.method)(stanza)
+                except Exception as e:
+                    stanza.exception(e)
+                handled = True
+                continue
+            handler.prerun(stanza)
+            try:
+                handler.run(stanza)
+            except Exception as e:
+                stanza.exception(e)
+            if handler.check_delete():
+                self.handler_index.discard(handler)
+            handled = True
+
+        # Some stanzas require responses, such as Iq queries.
+        if not handled:
+            stanza.unhandled()
+
+    def _spawn_event(self, xml):
+        if self.successor is not None:
+            # the session was resumed by another stream
+            self.successor._spawn_event(xml)
+            return
+        self.shaper.count_stanza()
+        if self.sm:
+            self.sm.received(xml)
+        super(Stream, self)._spawn_event(xml)
+
     def abort(self):
         pass
 
@@ -196,9 +348,31 @@ class Stream(BaseXMPP):
         else:
             self.send_raw(data)
 
-    def send_element(self, xml):
-        self.send_raw(tostring(xml, xmlns=self.default_ns,
-                               stream=self, top_level=True))
+    def send_element(self, xml, text=None):
+        # text is the xml as serialized by the sender, if it
+        # came over IPC unmodified (see ipc_send)
+        if text is None:
+            text = tostring(xml, xmlns=self.default_ns,
+                            stream=self, top_level=True)
+        self.send_raw(text)
+
+    # Session Resumption (XEP-0198)
+
+    def drop_connection(self):
+        # close the current connection without ending the session
+        pass
+
+    def take_connection(self, other):
+        # take over the connection of another stream
+        pass
+
+    def retire(self, successor):
+        # called on a stream whose connection was taken over by
+        # a resumed session; it hasn't been bound to a resource,
+        # so the auth hook is the only thing to clean up
+        self.successor = successor
+        live_streams.discard(self)
+        self.loop.create_task(self.unbind())
 
     def send_error(self, error=None):
         if error:
@@ -210,6 +384,57 @@ class Stream(BaseXMPP):
         if self.whitespace_keepalive:
             super(Stream, self)._start_keepalive(event)
 
+    # Outbound Queue
+
+    def get_queue_depth(self):
+        # number of stanzas waiting to be delivered to the client
+        return 0
+
+    def get_backlog(self):
+        # stanzas not yet delivered or, with stream management,
+        # not yet acknowledged by the client
+        depth = self.get_queue_depth()
+        if self.sm:
+            depth = max(depth, self.sm.get_queue_depth())
+        return depth
+
+    def check_queue(self):
+        depth = self.get_backlog()
+        if depth > settings.STREAM_QUEUE_LIMIT:
+            self.queue_overflow(depth)
+        elif self.ipc_paused and depth <= settings.STREAM_QUEUE_LIMIT // 2:
+            self.logger.info('Outbound queue drained, resuming inbox')
+            self.ipc_paused = False
+            self.ipc_resume_event.set()
+
+    def queue_overflow(self, depth):
+        if self.ipc_paused:
+            return
+        policy = settings.STREAM_QUEUE_POLICY
+        if policy == 'drop-presence':
+            self.drop_superseded_presence()
+            depth = self.get_backlog()
+            if depth <= settings.STREAM_QUEUE_LIMIT:
+                return
+        elif policy == 'close':
+            self.logger.warning('Outbound queue full (%d stanzas), closing stream',
+                                depth)
+            # stop reading the inbox, and avoid getting here again
+            # while sending the stream error into the full queue
+            self.ipc_paused = True
+            self.ipc_resume_event.clear()
+            error = StreamError()
+            error['condition'] = 'policy-violation'
+            self.send_error(error)
+            return
+        self.logger.warning('Outbound queue full (%d stanzas), pausing inbox',
+                            depth)
+        self.ipc_paused = True
+        self.ipc_resume_event.clear()
+
+    def drop_superseded_presence(self):
+        pass
+
     def is_local(self, domain):
         return domain == self.host
 
@@ -259,49 +484,142 @@ class Stream(BaseXMPP):
     def group_for_user(jid):
         return 'xmpp.user.' + jid.user
 
+    async def ipc_bind(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        self.group_name = self.group_for_user(self.boundjid)
+        # messages from the channel layer and from streams in this
+        # process end up here, and are handled in the order they arrive
+        self.ipc_inbox = asyncio.Queue(
+            self.channel_layer.get_capacity(self.channel_name))
+        if settings.STREAM_LOCAL_DELIVERY:
+            # with the in-memory channel layer, there's nobody else,
+            # so the channel layer isn't needed at all
+            self.ipc_local_only = isinstance(self.channel_layer,
+                                             InMemoryChannelLayer)
+            self.ipc_local_keys = (self.group_name, self.boundjid.full,
+                                   self.channel_name)
+            local_groups.setdefault(self.group_name, []).append(self)
+            local_jids[self.boundjid.full] = self
+            local_channels[self.channel_name] = self
+        if not self.ipc_local_only:
+            await self.channel_layer.group_add(self.group_name,
+                                               self.channel_name)
+        self.recv_task = self.loop.create_task(self._receive_task())
+
     async def _receive_task(self):
-        await self.channel_layer.group_add(self.group_name,
-                                           self.channel_name)
+        forward_task = None
+        if not self.ipc_local_only:
+            forward_task = self.loop.create_task(self._forward_task())
+        try:
+            while True:
+                if self.ipc_paused:
+                    # slow client, leave messages in the inbox
+                    # until its outbound queue has drained
+                    await self.ipc_resume_event.wait()
+                msg = await self.ipc_inbox.get()
+                await self._ipc_received(msg)
+        finally:
+            if forward_task:
+                forward_task.cancel()
+
+    async def _forward_task(self):
         while True:
+            if self.ipc_paused:
+                # leave messages in the channel layer, too
+                await self.ipc_resume_event.wait()
             msg = await self.channel_layer.receive(self.channel_name)
-            await self._ipc_received(msg)
+            if msg.get('node') == node_id:
+                # already delivered directly, see ipc_send
+                continue
+            await self.ipc_inbox.put(msg)
 
     async def _cleanup_task(self):
+        if self.ipc_local_keys:
+            group_name, jid, channel_name = self.ipc_local_keys
+            streams = local_groups.get(group_name, [])
+            if self in streams:
+                streams.remove(self)
+                if not streams:
+                    del local_groups[group_name]
+            if local_jids.get(jid) is self:
+                del local_jids[jid]
+            if local_channels.get(channel_name) is self:
+                del local_channels[channel_name]
+            self.ipc_local_keys = None
         if self.group_name:
-            await self.channel_layer.group_discard(self.group_name,
-                                                   self.channel_name)
+            if not self.ipc_local_only:
+                await self.channel_layer.group_discard(self.group_name,
+                                                       self.channel_name)
             self.group_name = None
         self.channel_name = None
 
+    def ipc_deliver(self, msg):
+        # Called for messages from streams in this process. Like with
+        # the in-memory channel layer, each recipient gets a copy of
+        # the xml, since both senders and recipients may modify it.
+        msg = dict(msg, xml=deepcopy(msg['xml']))
+        try:
+            self.ipc_inbox.put_nowait(msg)
+        except asyncio.QueueFull:
+            # same as a full channel
+            self.ipc_logger.debug('IPC inbox full, dropping %s message',
+                                  msg['type'])
+
     def ipc_send_soon(self, type, target, xml):
         self.loop.create_task(self.ipc_send(type, target, xml))
 
-    async def ipc_send(self, type, target, xml):
+    async def ipc_send(self, type, target, xml, serialize=False):
+        # With serialize, the xml is also sent as text, for recipients
+        # that pass it on to their clients unmodified (as ipc_text,
+        # while their handler runs), so that it's serialized once,
+        # rather than once for every stream that receives it.
         group_name = self.group_for_user(target)
         if self.ipc_logger.isEnabledFor(logging.DEBUG):
             self.ipc_logger.debug("IPC-Send type %s from %s [%s] to %s: %s",
                                   type, self.boundjid, self.channel_name,
                                   target.bare, tostring(xml))
-        await self.channel_layer.group_send(
-            group_name, {
-                'type': type,
-                'origin': self.channel_name,
-                'from': self.boundjid.full,
-                'xml': xml,
-            })
+        msg = {
+            'type': type,
+            'origin': self.channel_name,
+            'from': self.boundjid.full,
+            'xml': xml,
+        }
+        if serialize:
+            msg['text'] = tostring(xml, top_level=True)
+        if settings.STREAM_LOCAL_DELIVERY:
+            if type == 'iq' and target.full in local_jids:
+                # only the stream bound to that resource will want it
+                local_jids[target.full].ipc_deliver(msg)
+                return
+            for stream in local_groups.get(group_name, ()):
+                stream.ipc_deliver(msg)
+            if self.ipc_local_only:
+                return
+            # streams in other processes still need it, and our
+            # own streams can recognize it by the node
+            msg['node'] = node_id
+        await self.channel_layer.group_send(group_name, msg)
 
     async def ipc_reply(self, type, channel, xml):
         if self.ipc_logger.isEnabledFor(logging.DEBUG):
             self.ipc_logger.debug("IPC-Reply type %s from %s to [%s]: %s",
                                   type, self.boundjid, channel,
                                   tostring(xml))
-        await self.channel_layer.send(
-            channel, {
-                'type': type,
-                'origin': self.channel_name,
-                'from': self.boundjid.full,
-                'xml': xml,
-            })
+        msg = {
+            'type': type,
+            'origin': self.channel_name,
+            'from': self.boundjid.full,
+            'xml': xml,
+        }
+        if settings.STREAM_LOCAL_DELIVERY:
+            stream = local_channels.get(channel)
+            if stream is not None:
+                stream.ipc_deliver(msg)
+                return
+            if self.ipc_local_only:
+                # the stream is gone
+                return
+        await self.channel_layer.send(channel, msg)
 
     async def _ipc_received(self, msg):
         type = msg['type']
@@ -318,6 +636,9 @@ class Stream(BaseXMPP):
             for attr in attrs[:-1]:
                 target = getattr(target, attr)
             target = getattr(target, 'ipc_recv_' + attrs[-1])
+            self.ipc_text = msg.get('text')
             await target(origin, ifrom, xml)
         except Exception as e:
             self.exception(e)
+        finally:
+            self.ipc_text = None
@@ -1,9 +1,15 @@
-from slixmpp import Callback, StanzaPath
-from slixmpp.xmlstream.stanzabase import ET, StanzaBase, register_stanza_plugin
-from slixmpp.stanza import StreamFeatures
+from slixmpp import StanzaPath
+from slixmpp.xmlstream.stanzabase import (ElementBase, StanzaBase,
+                                          register_stanza_plugin)
+from slixmpp.xmlstream import tostring
+from slixmpp.stanza import StreamError, StreamFeatures
 from slixmpp.features.feature_starttls import stanza as tls_stanza
+from .matcher import register_handlers
+from .outbound import drop_superseded, presence_key
 from .stream import Stream
 from ..conf import settings
+from ..xmlparser import make_pull_parser
+import zlib
 
 # tls_stanza.STARTTLS is meant as a feature flag
 # and thus doesn't subclass StanzaBase, so we
@@ -14,23 +20,85 @@ class StartTLS(StanzaBase):
     interfaces = set()
     plugin_attrib = name
 
+# Stream compression (XEP-0138)
+NS_COMPRESS_FEATURE = 'http://jabber.org/features/compress'
+NS_COMPRESS = 'http://jabber.org/protocol/compress'
+
+# compressed input is inflated at most this many bytes at a time
+INFLATE_CHUNK_SIZE = 65536
+
+class CompressionFeature(ElementBase):
+    name = 'compression'
+    namespace = NS_COMPRESS_FEATURE
+    interfaces = set()
+    plugin_attrib = name
+
+class Compress(StanzaBase):
+    name = 'compress'
+    namespace = NS_COMPRESS
+    interfaces = set(['method'])
+    plugin_attrib = name
+
+    # StanzaBase replaces self.namespace with the stream's
+    # default namespace, so sub_interfaces won't work here
+    def get_method(self):
+        return self.xml.findtext('{%s}method' % NS_COMPRESS, '')
+
+class Compressed(StanzaBase):
+    name = 'compressed'
+    namespace = NS_COMPRESS
+    interfaces = set()
+    plugin_attrib = name
+
+class CompressionFailure(StanzaBase):
+    name = 'failure'
+    namespace = NS_COMPRESS
+    interfaces = set()
+    plugin_attrib = 'compression_failure'
+
+register_stanza_plugin(StreamFeatures, tls_stanza.STARTTLS)
+register_stanza_plugin(StreamFeatures, CompressionFeature)
+
+tls_handlers = (
+    ('STARTTLS', StanzaPath('starttls'), '_handle_starttls'),
+)
+compress_handlers = (
+    ('Compress', StanzaPath('compress'), '_handle_compress'),
+)
+
 class TCPStream(Stream):
+    ping_keepalives = True
+    stream_management = True
+
     def __init__(self, protocol):
         super(TCPStream, self).__init__()
         self.update_logger({'transport': 'TCP'})
         self.protocol = protocol
         self.protocol_logger = protocol.logger
-        self.transport = protocol.transport
         self.tls_options = protocol.factory.options
         self.socket = None
+        if protocol.factory.direct_tls:
+            # TLS was established before the stream was opened (XEP-0368)
+            self.tls_options = None
+            self.features.add('starttls')
+        # Outgoing data is collected here and written out once per
+        # event loop iteration, so that bursts of stanzas (e.g. the
+        # presence probe replies after login) become a single write.
+        self.send_buffer = []
+        self.flush_handle = None
+        self.write_paused = False
+        self.read_paused = False
+        self.closed = False
+        self.compressor = None
+        self.decompressor = None
+        self.inflate_pending = b''
+        self.stanza_size = 0
         if self.tls_options:
-            register_stanza_plugin(StreamFeatures,
-                                   tls_stanza.STARTTLS)
             self.register_stanza(StartTLS)
-            self.register_handler(
-                Callback('STARTTLS',
-                         StanzaPath('starttls'),
-                         self._handle_starttls))
+            register_handlers(self, self, tls_handlers)
+        if settings.TCP_COMPRESSION:
+            self.register_stanza(Compress)
+            register_handlers(self, self, compress_handlers)
         self.add_event_handler('auth_success',
                                self._auth_success)
         self.add_event_handler('session_bind',
@@ -40,9 +108,7 @@ class TCPStream(Stream):
     def init_parser(self):
         self.xml_depth = 0
         self.xml_root = None
-        # workaround: slixmpp's xmlstream imports wrong type of ElementTree
-        # (imports xml.etree.ElementTree, but stanzabase uses cElementTree)
-        self.parser = ET.XMLPullParser(("start", "end"))
+        self.parser = make_pull_parser()
 
     async def get_features(self):
         if self.tls_options and settings.TCP_REQUIRE_TLS:
@@ -52,8 +118,18 @@ class TCPStream(Stream):
         if self.tls_options:
             features['starttls']._set_sub_text('required',
                                                keep=settings.TCP_REQUIRE_TLS)
+        if self.compression_available():
+            features['compression']._set_sub_text('method', 'zlib')
         return features
 
+    def compression_available(self):
+        # Offer compression after authentication (as recommended
+        # by XEP-0170), and after TLS, if TLS is going to be used.
+        return (settings.TCP_COMPRESSION and
+                self.compressor is None and
+                'mechanisms' in self.features and
+                not self.tls_options)
+
     async def send_init(self):
         self.stream_id = await self.generate_id()
         self.update_logger({'sid': self.stream_id})
@@ -70,27 +146,233 @@ class TCPStream(Stream):
         self.send_features()
 
     def abort(self):
-        self.transport.loseConnection()
+        if self.sm:
+            self.sm.terminate()
+        if self.closed:
+            return
+        # whatever's left (usually a stream error) is written even if
+        # the client is slow, which may well be why we're closing
+        self.flush(force=True)
+        self.closed = True
+        self.protocol.close()
+
+    def connection_lost(self, reason=None):
+        self.closed = True
+        self.send_buffer = []
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        super(TCPStream, self).connection_lost(reason)
+
+    def send_element(self, xml, text=None):
+        if text is None:
+            data = tostring(xml, xmlns=self.default_ns,
+                            stream=self, top_level=True)
+        else:
+            # redundantly declares the default namespace, which is fine
+            data = text
+        self.send_raw(data, presence_key(xml))
+        if self.sm:
+            self.sm.sent(xml, data)
+
+    def send_raw(self, data, key=None):
+        if self.closed:
+            return
+        self.send_buffer.append((data, key))
+        if self.write_paused:
+            # the client isn't keeping up
+            self.check_queue()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
 
-    def send_raw(self, data):
-        data = data.encode('utf8')
+    def flush(self, force=False):
+        # force is used before changing the connection's encoding
+        # (TLS or compression), since any buffered data must be
+        # written out the old way, whether or not the client is slow.
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.send_buffer or self.closed:
+            return
+        if self.write_paused and not force:
+            return
+        data = ''.join([data for data, key in self.send_buffer]).encode('utf8')
+        self.send_buffer = []
         self.protocol_logger.debug('Send: %s', data)
-        self.transport.write(data)
+        if self.compressor:
+            data = (self.compressor.compress(data) +
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.protocol.write(data)
+
+    def data_received(self, data):
+        if self.decompressor:
+            self.inflate_pending += data
+            self.inflate_received()
+        else:
+            self.parse_received(data)
+
+    def inflate_received(self):
+        # Compressed input is inflated and parsed a chunk at a time,
+        # so that a few kilobytes of it can't expand into unbounded
+        # memory before the stanza size limit gets to look at it.
+        # Whatever is left when reading gets paused waits for
+        # resume_reading().
+        while self.inflate_pending and self.decompressor and \
+              not self.read_paused and not self.closed:
+            try:
+                data = self.decompressor.decompress(self.inflate_pending,
+                                                    INFLATE_CHUNK_SIZE)
+            except zlib.error as e:
+                self.logger.info('Bad compressed data: %s', e)
+                self.inflate_pending = b''
+                error = StreamError()
+                error['condition'] = 'bad-format'
+                self.send_error(error)
+                return
+            self.inflate_pending = self.decompressor.unconsumed_tail
+            self.parse_received(data)
+            if self.successor is not None:
+                self.successor.inflate_received()
+                return
+
+    def parse_received(self, data):
+        self.shaper.count_bytes(len(data))
+        self.ping.received()
+        super(TCPStream, self).data_received(data)
+        if self.successor is not None:
+            # the session was resumed while parsing this data,
+            # so the resumed stream continues from here
+            self.successor.take_parser(self)
+            return
+        if self.xml_depth > 1:
+            # a stanza is still being received
+            self.stanza_size += len(data)
+            if self.stanza_size > settings.TCP_MAX_STANZA_SIZE:
+                self.logger.warning('Stanza larger than %d bytes, closing stream',
+                                    settings.TCP_MAX_STANZA_SIZE)
+                error = StreamError()
+                error['condition'] = 'policy-violation'
+                self.send_error(error)
+                return
+        else:
+            self.stanza_size = 0
+        delay = self.shaper.delay()
+        if delay and not self.read_paused and not self.closed:
+            # client is over its budget, stop reading for a while
+            self.read_paused = True
+            self.protocol.pause_reading()
+            self.loop.call_later(delay, self.resume_reading)
+
+    def resume_reading(self):
+        self.read_paused = False
+        self.protocol.resume_reading()
+        self.inflate_received()
+
+    # Session Resumption (XEP-0198)
+
+    def drop_connection(self):
+        self.closed = True
+        self.send_buffer = []
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.protocol.stream = None
+        # the connection is presumed dead, so don't wait
+        # for whatever the transport still has buffered
+        self.protocol.abort()
+
+    def take_connection(self, other):
+        self.protocol = other.protocol
+        self.protocol_logger = other.protocol_logger
+        self.protocol.stream = self
+        self.tls_options = other.tls_options
+        self.compressor = other.compressor
+        self.decompressor = other.decompressor
+        self.inflate_pending = other.inflate_pending
+        other.inflate_pending = b''
+        for feature in ('starttls', 'compression'):
+            if feature in other.features:
+                self.features.add(feature)
+            elif feature in self.features:
+                self.features.remove(feature)
+        self.write_paused = other.write_paused
+        self.closed = False
+        # anything the other stream hasn't written yet goes first
+        self.send_buffer = other.send_buffer
+        other.send_buffer = []
+        other.closed = True
+        if other.flush_handle:
+            other.flush_handle.cancel()
+            other.flush_handle = None
+        if self.send_buffer and not self.write_paused:
+            self.flush_handle = self.loop.call_soon(self.flush)
+        self.take_parser(other)
+        self.protocol_logger.info('Resumed stream %s', self.stream_id)
+
+    def take_parser(self, other):
+        self.parser = other.parser
+        self.xml_depth = other.xml_depth
+        self.xml_root = other.xml_root
+        self.stanza_size = other.stanza_size
+
+    # called by the protocol when the transport's
+    # write buffer fills up or drains again
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.flush()
+        self.check_queue()
+
+    def get_queue_depth(self):
+        return len(self.send_buffer)
+
+    def drop_superseded_presence(self):
+        count = len(self.send_buffer)
+        self.send_buffer = drop_superseded(self.send_buffer)
+        self.logger.info('Dropped %d superseded presence stanzas',
+                         count - len(self.send_buffer))
 
     def get_client_cert(self):
         if 'starttls' in self.features:
-            return self.transport.getPeerCertificate()
+            return self.protocol.get_peer_certificate()
         else:
             return None
 
     def _handle_starttls(self, xml):
         self.send(tls_stanza.Proceed())
+        # the proceed must go out before the TLS handshake starts
+        self.flush(force=True)
         self.protocol_logger.debug('Starting TLS')
-        self.transport.startTLS(self.tls_options)
+        self.protocol.start_tls(self.tls_options)
         self.tls_options = None
         self.features.add('starttls')
         self.init_parser()
 
+    def _handle_compress(self, compress):
+        if not self.compression_available():
+            failure = CompressionFailure()
+            failure._set_sub_text('setup-failed', keep=True)
+            self.send(failure)
+            return
+        if compress['method'] != 'zlib':
+            failure = CompressionFailure()
+            failure._set_sub_text('unsupported-method', keep=True)
+            self.send(failure)
+            return
+        self.send(Compressed())
+        # the compressed element itself is sent uncompressed
+        self.flush(force=True)
+        self.protocol_logger.debug('Starting compression')
+        self.compressor = zlib.compressobj(settings.TCP_COMPRESSION_LEVEL,
+                                           zlib.DEFLATED,
+                                           settings.TCP_COMPRESSION_WINDOW)
+        self.decompressor = zlib.decompressobj()
+        self.features.add('compression')
+        self.init_parser()
+
     def _auth_success(self, jid):
         self.protocol_logger.debug('Authenticated as %s', jid.bare)
         self.init_parser()
@@ -1,6 +1,11 @@
-from slixmpp import Callback, StanzaPath
+from slixmpp import StanzaPath
 from slixmpp.xmlstream import StanzaBase, tostring
+from .matcher import register_handlers
+from .outbound import drop_superseded, presence_key
 from .stream import StreamElement, Stream
+from ..conf import settings
+from collections import deque
+import asyncio
 
 NS_XMPP_FRAMING = 'urn:ietf:params:xml:ns:xmpp-framing'
 
@@ -13,35 +18,111 @@ class WSClose(StanzaBase):
     namespace = NS_XMPP_FRAMING
     interfaces = set()
 
+ws_handlers = (
+    ('WSOpen', StanzaPath('open'), '_handle_open'),
+    ('WSClose', StanzaPath('close'), '_handle_close'),
+)
+
 class WSStream(Stream):
     ping_keepalives = True
+    stream_management = True
 
     def __init__(self, consumer):
         super(WSStream, self).__init__()
         self.update_logger({'transport': 'WebSockets'})
         self.consumer = consumer
         self.closing = False
+        self.send_queue = deque() # (data, key) pairs
+        self.writer = None
+        self.close_pending = False
+        self.socket_closing = False
         self.register_stanza(WSOpen)
-        self.register_handler(
-            Callback('WSOpen',
-                     StanzaPath('open'),
-                     self._handle_open))
         self.register_stanza(WSClose)
-        self.register_handler(
-            Callback('WSClose',
-                     StanzaPath('close'),
-                     self._handle_close))
+        register_handlers(self, self, ws_handlers)
         self.add_event_handler('session_bind',
                                self._session_bind)
 
     def abort(self):
+        if self.sm:
+            self.sm.terminate()
+        if self.consumer is None or self.socket_closing:
+            return
+        if self.writer is not None:
+            # let the writer send what's queued first
+            self.close_pending = True
+            return
+        self.socket_closing = True
         self.loop.create_task(self.consumer.close_socket())
 
-    def send_element(self, xml):
-        self.send_raw(tostring(xml, top_level=True))
+    def connection_lost(self, reason=None):
+        self.consumer = None
+        # if the session is resumed, stream management resends these
+        self.send_queue.clear()
+        super(WSStream, self).connection_lost(reason)
+
+    def send_element(self, xml, text=None):
+        data = text
+        if data is None:
+            data = tostring(xml, top_level=True)
+        self.send_raw(data, presence_key(xml))
+        if self.sm:
+            self.sm.sent(xml, data)
+
+    def send_raw(self, data, key=None):
+        if self.consumer is None:
+            return
+        if self.socket_closing:
+            # nothing is going to write it
+            self.logger.debug('Socket closing, dropping: %s', data)
+            return
+        self.send_queue.append((data, key))
+        if self.writer is None:
+            self.writer = self.loop.create_task(self._write_task())
+        if len(self.send_queue) > settings.STREAM_QUEUE_LIMIT:
+            self.check_queue()
 
-    def send_raw(self, data):
-        self.loop.create_task(self.consumer.send_data(data))
+    async def _write_task(self):
+        # The only coroutine that writes to the consumer, so stanzas
+        # go out in order, and a burst of them costs a single task.
+        try:
+            while self.send_queue and self.consumer is not None:
+                data, key = self.send_queue.popleft()
+                await self.consumer.send_data(data)
+                if self.ipc_paused:
+                    self.check_queue()
+            if self.close_pending and self.consumer is not None:
+                self.close_pending = False
+                self.socket_closing = True
+                await self.consumer.close_socket()
+        finally:
+            self.writer = None
+
+    def get_queue_depth(self):
+        return len(self.send_queue)
+
+    def drop_superseded_presence(self):
+        count = len(self.send_queue)
+        self.send_queue = deque(drop_superseded(self.send_queue))
+        self.logger.info('Dropped %d superseded presence stanzas',
+                         count - len(self.send_queue))
+
+    # Session Resumption (XEP-0198)
+
+    def drop_connection(self):
+        consumer = self.consumer
+        self.consumer = None
+        self.send_queue.clear()
+        consumer.stream = None
+        self.loop.create_task(consumer.close_socket())
+
+    def take_connection(self, other):
+        self.consumer = other.consumer
+        self.consumer.stream = self
+        self.closing = False
+        self.close_pending = False
+        self.socket_closing = False
+        other.consumer = None
+        self.consumer.logger.info('Resumed stream %s', self.stream_id)
 
     async def send_init(self):
         self.stream_id = await self.generate_id()
@@ -70,7 +151,7 @@ class WSStream(Stream):
     def _session_bind(self, jid):
         self.consumer.logger.info('Bound to %s', jid.full)
 
-async def handle_ws(consumer, xml):
+async def handle_ws(consumer, xml, size=0):
     if not consumer.stream:
         if xml.tag == WSOpen.tag_name():
             consumer.stream = WSStream(consumer)
@@ -80,7 +161,15 @@ async def handle_ws(consumer, xml):
             # TODO: stream error?
             await consumer.close_socket()
             return
-    consumer.stream.handle_stanza(xml)
+    stream = consumer.stream
+    stream.handle_stanza(xml)
+    stream.shaper.count_bytes(size)
+    stream.ping.received()
+    delay = stream.shaper.delay()
+    if delay:
+        # client is over its budget, don't read the next
+        # message until it's back within it
+        await asyncio.sleep(delay)
 
 async def disconnect_ws(consumer):
     if consumer.stream is not None: